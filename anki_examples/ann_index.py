@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+from typing import Optional
+
+import numpy as np
+from tqdm import tqdm
+
+IVF_FOLDER = "ivf"
+# k-means needs enough training embeddings per cluster to place the centroids well
+MIN_TRAIN_PER_LIST = 40
+# Share of the clusters searched by default. A word's matches are spread over many clusters, so enough of them
+# have to be searched to find `num_examples` matches near the query
+PROBE_FRACTION = 0.05
+
+
+def gloss_query(wiktdata: str, en: str = "", word: str = "") -> str:
+    """Returns the text describing the target sense of a note, to find examples by meaning.
+
+    This is the main meaning of the first entry in the `wiktdata` field (see `json_dump_entries`), with the
+    masked word filled back in, or the English translation of the note if it has no Wiktionary data.
+    """
+    if wiktdata:
+        try:
+            entries = json.loads(wiktdata)
+        except json.JSONDecodeError:
+            entries = []
+        for entry in entries:
+            for meaning in entry.get("meanings", []):
+                if meaning.get("meaning"):
+                    return meaning["meaning"].replace("___", word)
+    return en
+
+
+class IVFIndex:
+    """Inverted file index for approximate nearest neighbour search over normalized embeddings, on the CPU.
+
+    The embeddings are clustered with spherical k-means, and a search only scores the embeddings in the
+    `nprobe` clusters closest to the query, by default `PROBE_FRACTION` of the clusters. The members of the
+    clusters are stored in CSR format like in `InvertedIndex`: the ids of cluster `i` are
+    `list_ids[list_offsets[i]:list_offsets[i + 1]]`, sorted.
+
+    Parameters
+    ----------
+    embeddings : np.ndarray
+        The normalized embeddings to index, e.g. the memory-mapped `EmbeddingStore.embeddings`. All of them
+        have to be encoded.
+    num_lists : int, optional
+        Number of clusters, defaults to sqrt(number of embeddings).
+    num_iters : int
+        Number of k-means iterations.
+    sample_size : int, optional
+        Number of embeddings to train the clusters on, at least and by default `MIN_TRAIN_PER_LIST` per cluster.
+    seed : int
+        Seed for the sampling.
+    max_scores : int
+        Maximum size of the similarity matrix of the embeddings and the centroids computed at once, so the
+        number of embeddings assigned to clusters at once shrinks with the number of clusters.
+    """
+
+    CENTROIDS_FILE = "centroids.npy"
+    LIST_IDS_FILE = "list_ids.npy"
+    LIST_OFFSETS_FILE = "list_offsets.npy"
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        num_lists: Optional[int] = None,
+        num_iters: int = 10,
+        sample_size: Optional[int] = None,
+        seed: int = 0,
+        max_scores: int = 2**26,
+    ):
+        self.embeddings = embeddings
+        num_embeddings = len(embeddings)
+        num_lists = num_lists or max(1, int(np.sqrt(num_embeddings)))
+        sample_size = max(sample_size or 0, MIN_TRAIN_PER_LIST * num_lists)
+        rng = np.random.default_rng(seed)
+
+        # Sorted sample ids read the memory-mapped embeddings sequentially
+        sample_ids = np.sort(
+            rng.choice(num_embeddings, min(sample_size, num_embeddings), replace=False)
+        )
+        sample = np.asarray(embeddings[sample_ids], dtype=np.float32)
+        num_lists = min(num_lists, len(sample))
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+        chunk_size = max(1, max_scores // num_lists)
+        for _ in tqdm(range(num_iters), desc="Training clusters"):
+            assignments = self._assign(sample, centroids, chunk_size)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            non_empty = norms[:, 0] > 0  # Empty clusters keep their centroid
+            centroids[non_empty] = sums[non_empty] / norms[non_empty]
+        self.centroids = centroids
+
+        assignments = self._assign(embeddings, centroids, chunk_size, progress=True)
+
+        # Stable sort keeps the ids sorted within each cluster
+        self.list_ids = np.argsort(assignments, kind="stable").astype(np.int64)
+        self.list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=num_lists), out=self.list_offsets[1:])
+
+    @staticmethod
+    def _assign(
+        embeddings: np.ndarray, centroids: np.ndarray, chunk_size: int, progress: bool = False
+    ) -> np.ndarray:
+        """Returns the closest centroid of each embedding, scoring `chunk_size` embeddings at a time."""
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        starts = range(0, len(embeddings), chunk_size)
+        for start in tqdm(starts, desc="Assigning clusters") if progress else starts:
+            chunk = np.asarray(embeddings[start : start + chunk_size], dtype=np.float32)
+            assignments[start : start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+        return assignments
+
+    def save(self, folder: str) -> None:
+        """Writes the clusters to the folder, the embeddings are not included."""
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, self.CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(folder, self.LIST_IDS_FILE), self.list_ids)
+        np.save(os.path.join(folder, self.LIST_OFFSETS_FILE), self.list_offsets)
+
+    @classmethod
+    def load(cls, folder: str, embeddings: np.ndarray) -> "IVFIndex":
+        """Loads an index written with `save` over the given embeddings, the clusters are memory-mapped."""
+        index = cls.__new__(cls)
+        index.embeddings = embeddings
+        index.centroids = np.load(os.path.join(folder, cls.CENTROIDS_FILE))
+        index.list_ids = np.load(os.path.join(folder, cls.LIST_IDS_FILE), mmap_mode="r")
+        index.list_offsets = np.load(os.path.join(folder, cls.LIST_OFFSETS_FILE))
+        return index
+
+    def __len__(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def default_nprobe(self) -> int:
+        return min(max(8, int(np.ceil(PROBE_FRACTION * len(self)))), len(self))
+
+    def probe(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """Returns the sorted ids of the embeddings in the `nprobe` clusters closest to the query.
+
+        Defaults to `default_nprobe` clusters.
+        """
+        nprobe = min(nprobe or self.default_nprobe, len(self))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        ids = np.concatenate(
+            [self.list_ids[self.list_offsets[i] : self.list_offsets[i + 1]] for i in lists]
+        )
+        return np.sort(ids)
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        nprobe: Optional[int] = None,
+        candidates: Optional[np.ndarray] = None,
+    ):
+        """Finds the approximately `k` most similar embeddings to the normalized query.
+
+        Parameters
+        ----------
+        query : np.ndarray
+            The normalized query embedding.
+        k : int
+            Number of results.
+        nprobe : int, optional
+            Number of clusters to search, more is slower but more accurate. Defaults to `default_nprobe`.
+        candidates : np.ndarray, optional
+            Sorted ids to restrict the search to, e.g. the sentences containing a word.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            The ids and similarities of the results, most similar first.
+        """
+        ids = self.probe(query, nprobe)
+        if candidates is not None:
+            ids = np.intersect1d(ids, candidates, assume_unique=True)
+        scores = np.asarray(self.embeddings[ids], dtype=np.float32) @ query
+        top = np.argsort(-scores, kind="stable")[:k]
+        return ids[top], scores[top]
+
+
+if __name__ == "__main__":
+    from anki_examples.corpus_store import is_corpus_store, load_corpus_store, prepare_corpus
+    from anki_examples.notebooks.semantic_ranking import SimilarityRanker, format_example
+
+    parser = argparse.ArgumentParser(
+        description="Encodes all sentences of a corpus into an embedding store and builds an IVF index over them."
+    )
+    parser.add_argument(
+        "--corpus", type=str, help="Corpus folder or corpus store", required=True
+    )
+    parser.add_argument(
+        "--embeddings", type=str, help="Folder of the embedding store", required=True
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
+        help="Sentence embedding model",
+    )
+    parser.add_argument(
+        "--device", type=str, default=None, help="Device of the model, defaults to the GPU if available"
+    )
+    parser.add_argument(
+        "--num_lists", type=int, default=None, help="Number of IVF clusters, defaults to sqrt(number of sentences)"
+    )
+    parser.add_argument(
+        "--sample_size", type=int, default=None, help="Number of sentences to train the clusters on"
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=100_000, help="Number of sentences to encode at once"
+    )
+    args = parser.parse_args()
+
+    if is_corpus_store(args.corpus):
+        corpus = load_corpus_store(args.corpus)
+    else:
+        corpus = prepare_corpus(args.corpus)
+
+    ranker = SimilarityRanker(args.model, device=args.device)
+    store = ranker.open_store(args.embeddings, corpus)
+    missing = store.missing(np.arange(len(corpus)))
+    print("Sentences to encode:", len(missing))
+    for start in tqdm(range(0, len(missing), args.chunk_size), desc="Encoding corpus"):
+        ids = missing[start : start + args.chunk_size]
+        store.add(ids, ranker.encode_numpy([format_example(corpus.texts[i]) for i in ids]))
+        store.flush()
+
+    index = IVFIndex(store.embeddings, num_lists=args.num_lists, sample_size=args.sample_size)
+    index.save(os.path.join(args.embeddings, IVF_FOLDER))
+    print("IVF index with", len(index), "clusters written to", args.embeddings)
@@ -0,0 +1,116 @@
+import argparse
+import os
+import random
+import time
+from typing import List, Set
+
+from anki_examples.process_subs import get_sub_list, read_subtitle
+from anki_examples.segmenters import RuleSegmenter, WtpSegmenter
+
+
+def boundaries(sentences: List[str]) -> Set[int]:
+    """Returns the sentence boundaries as offsets in the text without whitespace, so they are comparable
+    between segmenters that strip the sentences differently."""
+    offsets = set()
+    offset = 0
+    for sentence in sentences[:-1]:
+        offset += sum(not c.isspace() for c in sentence)
+        offsets.add(offset)
+    return offsets
+
+
+def boundary_f1(predicted: List[List[str]], reference: List[List[str]]) -> float:
+    """F1 score of the predicted sentence boundaries against the reference ones, over all texts."""
+    true_positives = num_predicted = num_reference = 0
+    for pred_sentences, ref_sentences in zip(predicted, reference):
+        pred, ref = boundaries(pred_sentences), boundaries(ref_sentences)
+        true_positives += len(pred & ref)
+        num_predicted += len(pred)
+        num_reference += len(ref)
+    if true_positives == 0:
+        return 0.0
+    precision = true_positives / num_predicted
+    recall = true_positives / num_reference
+    return 2 * precision * recall / (precision + recall)
+
+
+def benchmark(segmenter, texts: List[str]):
+    """Returns the segmented texts and the time it took in seconds, after a warm-up on a few texts."""
+    list(segmenter.split(texts[:4]))
+    start = time.perf_counter()
+    splits = [list(sentences) for sentences in segmenter.split(texts)]
+    return splits, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the sentence segmenters of process_subs on a sample of subtitle files."
+    )
+    parser.add_argument(
+        "--subs", type=str, help="Folder with the subtitle zips", required=True
+    )
+    parser.add_argument(
+        "--num_files", type=int, default=200, help="Number of files to sample"
+    )
+    parser.add_argument(
+        "--devices",
+        nargs="+",
+        default=["cpu", "cuda"],
+        help="Devices to run the WtP model on, unavailable ones are skipped",
+    )
+    parser.add_argument("--model", default="wtp-bert-mini", help="Name of the WtP model")
+    parser.add_argument(
+        "--batch_size", type=int, default=32, help="Batch size of the model"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of threads on the CPU"
+    )
+    parser.add_argument(
+        "--min_words", type=int, default=4, help="Minimum words of a corpus example"
+    )
+    parser.add_argument(
+        "--max_words", type=int, default=15, help="Maximum words of a corpus example"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the sampling")
+    args = parser.parse_args()
+
+    import torch
+
+    subs_list = get_sub_list(args.subs)
+    random.seed(args.seed)
+    sample = random.sample(subs_list, min(args.num_files, len(subs_list)))
+    texts = []
+    for file in sample:
+        try:
+            texts.append(read_subtitle(os.path.join(args.subs, file)))
+        except Exception as e:
+            print("Skipping", file, e)
+    num_chars = sum(len(text) for text in texts)
+    print(f"Files: {len(texts)}, characters: {num_chars}")
+
+    segmenters = {"rules": RuleSegmenter()}
+    for device in args.devices:
+        if device == "cuda" and not torch.cuda.is_available():
+            print("Skipping cuda, no GPU available")
+            continue
+        segmenters[f"wtp-{device}"] = WtpSegmenter(
+            args.model, device=device, batch_size=args.batch_size, threads=args.threads
+        )
+
+    results = {name: benchmark(segmenter, texts) for name, segmenter in segmenters.items()}
+    # The model is the reference for the split quality, the devices should agree
+    reference_name = next((name for name in results if name.startswith("wtp")), "rules")
+    reference = results[reference_name][0]
+
+    print(f"Boundary F1 against {reference_name}")
+    print(f"{'segmenter':10} {'files/s':>9} {'kchars/s':>9} {'sentences':>10} {'in range':>9} {'F1':>6}")
+    for name, (splits, seconds) in results.items():
+        num_words = [
+            len(sentence.split()) for sentences in splits for sentence in sentences
+        ]
+        in_range = sum(args.min_words <= n <= args.max_words for n in num_words)
+        print(
+            f"{name:10} {len(texts) / seconds:9.1f} {num_chars / seconds / 1000:9.1f}"
+            f" {len(num_words):10} {in_range / max(len(num_words), 1):9.1%}"
+            f" {boundary_f1(splits, reference):6.3f}"
+        )
@@ -0,0 +1,137 @@
+import json
+import os
+import re
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+TOKEN_PATTERN = r"\w+"
+TOKEN_REGEX = re.compile(TOKEN_PATTERN)
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits a text into lower case tokens (Vietnamese syllables), dropping punctuation and spaces."""
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def example_pattern(example: str) -> str:
+    """Builds the pattern that matches the example as a whole word (sequence) in a sentence.
+
+    cudf doesn't support case insensitive search, so we try lower case, upper case and title case.
+    """
+    ex_escaped = re.escape(example)
+    return rf"(^|\W)({ex_escaped.lower()}|{ex_escaped.title()}|{ex_escaped.upper()})($|\W)"
+
+
+class TokenTrie:
+    """Trie over the token sequences of many words, to find all of them in a tokenized sentence at once."""
+
+    END = None  # Key of the words ending at a node, can't collide with a token
+
+    def __init__(self):
+        self.root: dict = {}
+        self.max_depth = 0
+
+    def add(self, tokens: List[str], value) -> None:
+        node = self.root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node.setdefault(self.END, []).append(value)
+        self.max_depth = max(self.max_depth, len(tokens))
+
+    def find_all(self, tokens: List[str]) -> List:
+        """Returns the values of all token sequences that occur contiguously in `tokens`."""
+        found = []
+        for start in range(len(tokens)):
+            node = self.root
+            for token in tokens[start : start + self.max_depth]:
+                node = node.get(token)
+                if node is None:
+                    break
+                found.extend(node.get(self.END, ()))
+        return found
+
+
+class InvertedIndex:
+    """Inverted index from token to the sorted positions of the sentences containing it.
+
+    The posting lists are stored in CSR format: the postings of the token with id `i` are
+    `postings[offsets[i]:offsets[i + 1]]`.
+
+    Parameters
+    ----------
+    texts : Sequence[str]
+        The sentences of the corpus. Positions in the posting lists refer to this sequence.
+    """
+
+    def __init__(self, texts: Sequence[str]):
+        tokens = pd.Series(list(texts), dtype=object).str.lower().str.findall(TOKEN_PATTERN)
+        exploded = tokens.explode().dropna()
+
+        # The exploded index is the sentence position, drop repeated tokens within a sentence
+        pairs = pd.DataFrame(
+            {"token": exploded.to_numpy(), "sentence": exploded.index.to_numpy()}
+        ).drop_duplicates()
+        codes, vocab = pd.factorize(pairs["token"])
+
+        # Stable sort by token keeps the sentence positions sorted within each posting list
+        order = np.argsort(codes, kind="stable")
+        self.postings = pairs["sentence"].to_numpy()[order].astype(np.int32)
+        self.offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(vocab)), out=self.offsets[1:])
+        self.vocab = {token: i for i, token in enumerate(vocab)}
+
+    POSTINGS_FILE = "postings.npy"
+    OFFSETS_FILE = "token_offsets.npy"
+    VOCAB_FILE = "vocab.json"
+
+    def save(self, folder: str) -> None:
+        """Writes the index to the folder, so it can be memory-mapped with `load`."""
+        np.save(os.path.join(folder, self.POSTINGS_FILE), self.postings)
+        np.save(os.path.join(folder, self.OFFSETS_FILE), self.offsets)
+        with open(os.path.join(folder, self.VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump(list(self.vocab), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, folder: str) -> "InvertedIndex":
+        """Loads an index written with `save`, the posting lists are memory-mapped."""
+        index = cls.__new__(cls)
+        index.postings = np.load(os.path.join(folder, cls.POSTINGS_FILE), mmap_mode="r")
+        index.offsets = np.load(os.path.join(folder, cls.OFFSETS_FILE), mmap_mode="r")
+        with open(os.path.join(folder, cls.VOCAB_FILE), "r", encoding="utf-8") as f:
+            index.vocab = {token: i for i, token in enumerate(json.load(f))}
+        return index
+
+    def __len__(self) -> int:
+        return len(self.vocab)
+
+    def posting_list(self, token: str) -> np.ndarray:
+        """Returns the sorted positions of the sentences containing the token."""
+        i = self.vocab.get(token)
+        if i is None:
+            return np.empty(0, dtype=np.int32)
+        return self.postings[self.offsets[i] : self.offsets[i + 1]]
+
+    def candidates(self, example: str) -> Optional[np.ndarray]:
+        """Finds the sentences that contain all tokens of the example, by intersecting their posting lists.
+
+        The candidates are a superset of the sentences matching `example_pattern`, the exact match
+        still has to be checked on them.
+
+        Returns
+        -------
+        Optional[np.ndarray]
+            The sorted sentence positions, or None if the example has no tokens and the index can't be used.
+        """
+        tokens = set(tokenize(example))
+        if not tokens:
+            return None
+
+        posting_lists = sorted((self.posting_list(t) for t in tokens), key=len)
+        result = posting_lists[0]
+        for posting_list in posting_lists[1:]:
+            if len(result) == 0:
+                break
+            result = np.intersect1d(result, posting_list, assume_unique=True)
+        return result
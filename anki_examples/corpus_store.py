@@ -0,0 +1,410 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from anki_examples.corpus_index import TOKEN_PATTERN, InvertedIndex
+
+# Bump this whenever the layout of the store changes
+STORE_VERSION = 2
+META_FILE = "corpus_store.json"
+TEXTS_FILE = "texts.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+FILE_IDS_FILE = "file_ids.npy"
+NUM_WORDS_FILE = "num_words.npy"
+FILES_FILE = "files.json"
+SOURCE_OFFSETS_FILE = "source_offsets.npy"
+SOURCE_FILE_IDS_FILE = "source_file_ids.npy"
+
+DEDUP_MODES = ["none", "exact", "normalized"]
+
+
+class MappedTexts(Sequence):
+    """Read-only sequence of sentences stored as one contiguous memory-mapped UTF-8 blob."""
+
+    def __init__(self, blob_path: str, offsets: np.ndarray):
+        self.offsets = offsets
+        self._file = open(blob_path, "rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:  # mmap cannot map empty files
+            self._blob = b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Sentence index {i} out of range")
+        return self._blob[self.offsets[i] : self.offsets[i + 1]].decode("utf-8")
+
+
+def _update_fingerprint(fingerprint, text: str):
+    fingerprint.update(text.encode("utf-8"))
+    fingerprint.update(b"\0")  # Separator, so moving words between sentences changes the fingerprint
+
+
+class Corpus:
+    """The example sentences of the corpus with the file they are from and their number of words.
+
+    The texts can either be a list in memory or memory-mapped from a store, see `load_corpus_store`.
+
+    Parameters
+    ----------
+    texts : Sequence[str]
+        The example sentences.
+    file_ids : np.ndarray
+        For each sentence, the position of its file in `files`.
+    num_words : np.ndarray
+        For each sentence, its number of words.
+    files : List[str]
+        The names of the files of the corpus.
+    index : InvertedIndex, optional
+        A prebuilt inverted index over the texts.
+    source_offsets : np.ndarray, optional
+        For deduplicated corpora, the files of sentence `i` are
+        `source_file_ids[source_offsets[i]:source_offsets[i + 1]]`, see `deduplicate_corpus`.
+    source_file_ids : np.ndarray, optional
+        The file ids of all sentences, see `source_offsets`.
+    fingerprint : str, optional
+        The fingerprint of the texts if it is known, e.g. from the meta of a store, see `Corpus.fingerprint`.
+    """
+
+    def __init__(
+        self,
+        texts: Sequence[str],
+        file_ids: np.ndarray,
+        num_words: np.ndarray,
+        files: List[str],
+        index: Optional[InvertedIndex] = None,
+        source_offsets: Optional[np.ndarray] = None,
+        source_file_ids: Optional[np.ndarray] = None,
+        fingerprint: Optional[str] = None,
+    ):
+        self.texts = texts
+        self.file_ids = file_ids
+        self.num_words = num_words
+        self.files = files
+        self.index = index
+        self.source_offsets = source_offsets
+        self.source_file_ids = source_file_ids
+        self._fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def record(self, i: int) -> dict:
+        """Returns the sentence at position `i` in the same format as a row of `to_dataframe`."""
+        return {
+            "file": self.files[self.file_ids[i]],
+            "text": self.texts[i],
+            "num_words": int(self.num_words[i]),
+        }
+
+    def records(self, positions: Sequence[int]) -> List[dict]:
+        return [self.record(i) for i in positions]
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the texts in their order, which changes if the sentence at any position changes.
+
+        Data stored by sentence position, like the embedding store, is only valid for a corpus with the same
+        fingerprint. It is computed on first use, or read from the meta of a corpus store.
+        """
+        if self._fingerprint is None:
+            fingerprint = hashlib.sha1()
+            for text in self.texts:
+                _update_fingerprint(fingerprint, text)
+            self._fingerprint = fingerprint.hexdigest()
+        return self._fingerprint
+
+    def sources(self, i: int) -> List[str]:
+        """Returns all files the sentence at position `i` occurs in."""
+        if self.source_offsets is None:
+            return [self.files[self.file_ids[i]]]
+        file_ids = self.source_file_ids[self.source_offsets[i] : self.source_offsets[i + 1]]
+        return [self.files[file_id] for file_id in file_ids]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Returns the corpus as a DataFrame with the columns file, text and num_words."""
+        files = np.array(self.files, dtype=object)
+        return pd.DataFrame(
+            {
+                "file": files[np.asarray(self.file_ids)] if len(files) else [],
+                "text": list(self.texts),
+                "num_words": np.asarray(self.num_words),
+            }
+        )
+
+
+def read_corpus_file(
+    file_path: str, min_words: int = 4, max_words: int = 15
+) -> tuple[int, List[str], List[int]]:
+    """Reads one file of the corpus, with an example sentence for each line.
+
+    Returns
+    -------
+    tuple[int, List[str], List[int]]
+        The number of unique lines, and the unique sentences with `min_words` to `max_words` words
+        together with their number of words.
+    """
+    with open(file_path, "r") as f:
+        # Read the whole file at once, strip each line and remove duplicates
+        content = f.read()
+    if content.endswith("\n"):
+        content = content[:-1]
+    lines = set(line.strip() for line in content.split("\n"))
+
+    texts, num_words = [], []
+    for line in lines:
+        line_num_words = line.count(" ") + 1
+        if min_words <= line_num_words <= max_words:
+            texts.append(line)
+            num_words.append(line_num_words)
+    return len(lines), texts, num_words
+
+
+def deduplicate_corpus(corpus: Corpus, normalized: bool = False) -> Corpus:
+    """Removes duplicate sentences across all files of the corpus.
+
+    Subtitle dumps contain many releases of the same movie, so the same sentence occurs in many files.
+    Only the first occurrence of each sentence is kept, together with the list of all files it occurs in.
+
+    Parameters
+    ----------
+    corpus : Corpus
+        The corpus to deduplicate.
+    normalized : bool, optional
+        Consider sentences equal if they only differ in case, punctuation and spacing.
+
+    Returns
+    -------
+    Corpus
+        The deduplicated corpus with `source_offsets` and `source_file_ids`.
+    """
+    keys = pd.Series(list(corpus.texts), dtype=object)
+    if normalized:
+        keys = keys.str.lower().str.findall(TOKEN_PATTERN).str.join(" ")
+
+    # Hash based, the codes are numbered in order of the first occurrence
+    codes, uniques = pd.factorize(keys)
+    _, first = np.unique(codes, return_index=True)
+
+    file_ids = np.asarray(corpus.file_ids)
+    pairs = pd.DataFrame({"sentence": codes, "file": file_ids}).drop_duplicates()
+    order = np.argsort(pairs["sentence"].to_numpy(), kind="stable")
+    source_offsets = np.zeros(len(uniques) + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(pairs["sentence"].to_numpy(), minlength=len(uniques)),
+        out=source_offsets[1:],
+    )
+
+    return Corpus(
+        [corpus.texts[i] for i in first],
+        file_ids[first],
+        np.asarray(corpus.num_words)[first],
+        corpus.files,
+        source_offsets=source_offsets,
+        source_file_ids=pairs["file"].to_numpy()[order].astype(np.int32),
+    )
+
+
+def prepare_corpus(
+    corpus_folder: str,
+    min_words: int = 4,
+    max_words: int = 15,
+    workers: Optional[int] = None,
+    dedup: str = "exact",
+) -> Corpus:
+    """Prepare the corpus from the given folder.
+
+    Each file in the folder is a document in the corpus, with an example sentence for each line.
+    Duplicate lines within a file are removed and only sentences with `min_words` to `max_words` words are kept.
+    The files are read and filtered in a process pool.
+
+    Parameters
+    ----------
+    corpus_folder : str
+        The folder of the corpus files.
+    min_words : int, optional
+        Minimum number of words of an example.
+    max_words : int, optional
+        Maximum number of words of an example.
+    workers : int, optional
+        Number of processes to read the files with. Defaults to the number of CPUs, 1 reads them in this process.
+    dedup : str, optional
+        Remove duplicate sentences across files: "none", "exact" or "normalized" (ignoring case and punctuation).
+    """
+    print("Preparing corpus from", corpus_folder)
+
+    available_files = [fname for fname in os.listdir(corpus_folder)]
+    paths = [os.path.join(corpus_folder, fname) for fname in available_files]
+    read_file = partial(read_corpus_file, min_words=min_words, max_words=max_words)
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers)
+        # map keeps the order of the files, so the corpus is the same as when reading serially
+        results = executor.map(read_file, paths, chunksize=16)
+    else:
+        executor = None
+        results = map(read_file, paths)
+
+    files, texts, file_ids, num_words = [], [], [], []
+    total_examples = 0
+    try:
+        for file_name, (num_lines, file_texts, file_num_words) in tqdm(
+            zip(available_files, results), total=len(paths), desc="Reading corpus"
+        ):
+            total_examples += num_lines
+            # Assumes openSubs format
+            files.append(file_name.rsplit(".", 4)[0])
+            texts.extend(file_texts)
+            file_ids.extend([len(files) - 1] * len(file_texts))
+            num_words.extend(file_num_words)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print("Corpus prepared with", len(files), "files")
+    print("Total Examples", total_examples)
+    print("Filtered Examples", len(texts))
+    corpus = Corpus(
+        texts,
+        np.array(file_ids, dtype=np.int32),
+        np.array(num_words, dtype=np.int32),
+        files,
+    )
+
+    if dedup not in DEDUP_MODES:
+        raise ValueError(f"Unknown dedup mode {dedup}, choose one of {DEDUP_MODES}")
+    if dedup != "none":
+        corpus = deduplicate_corpus(corpus, normalized=dedup == "normalized")
+        print("Unique Examples", len(corpus))
+    return corpus
+
+
+def is_corpus_store(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, META_FILE))
+
+
+def write_corpus_store(corpus: Corpus, out_folder: str, build_index: bool = True) -> None:
+    """Writes the corpus as a store that can be memory-mapped with `load_corpus_store`.
+
+    The sentences are written as one contiguous UTF-8 blob with an offsets array, next to the file ids,
+    the word counts and optionally the inverted index. The store is written to a temporary folder first
+    and then moved in place.
+    """
+    tmp_folder = out_folder.rstrip(os.sep) + f".tmp{os.getpid()}"
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    offsets = np.zeros(len(corpus) + 1, dtype=np.int64)
+    fingerprint = hashlib.sha1()
+    with open(os.path.join(tmp_folder, TEXTS_FILE), "wb") as blob:
+        for i, text in enumerate(corpus.texts):
+            offsets[i + 1] = offsets[i] + blob.write(text.encode("utf-8"))
+            _update_fingerprint(fingerprint, text)
+    np.save(os.path.join(tmp_folder, TEXT_OFFSETS_FILE), offsets)
+    np.save(os.path.join(tmp_folder, FILE_IDS_FILE), np.asarray(corpus.file_ids, dtype=np.int32))
+    np.save(os.path.join(tmp_folder, NUM_WORDS_FILE), np.asarray(corpus.num_words, dtype=np.int32))
+    with open(os.path.join(tmp_folder, FILES_FILE), "w", encoding="utf-8") as f:
+        json.dump(corpus.files, f, ensure_ascii=False)
+    if corpus.source_offsets is not None:
+        np.save(os.path.join(tmp_folder, SOURCE_OFFSETS_FILE), corpus.source_offsets)
+        np.save(os.path.join(tmp_folder, SOURCE_FILE_IDS_FILE), corpus.source_file_ids)
+
+    if build_index:
+        print("Building the inverted index...")
+        index = corpus.index or InvertedIndex(corpus.texts)
+        index.save(tmp_folder)
+
+    with open(os.path.join(tmp_folder, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "sentences": len(corpus),
+                "files": len(corpus.files),
+                "index": build_index,
+                "sources": corpus.source_offsets is not None,
+                "fingerprint": fingerprint.hexdigest(),
+            },
+            f,
+        )
+
+    if os.path.exists(out_folder):
+        shutil.rmtree(out_folder)
+    os.replace(tmp_folder, out_folder)
+
+
+def load_corpus_store(folder: str) -> Corpus:
+    """Loads a corpus store, the sentences, word counts and the inverted index are memory-mapped.
+
+    Loading is near-instant and the pages are shared between processes that load the same store.
+    """
+    with open(os.path.join(folder, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta["version"] != STORE_VERSION:
+        raise ValueError(
+            f"Corpus store {folder} has version {meta['version']}, expected {STORE_VERSION}. Please rebuild it."
+        )
+
+    offsets = np.load(os.path.join(folder, TEXT_OFFSETS_FILE), mmap_mode="r")
+    with open(os.path.join(folder, FILES_FILE), "r", encoding="utf-8") as f:
+        files = json.load(f)
+    if meta["sources"]:
+        source_offsets = np.load(os.path.join(folder, SOURCE_OFFSETS_FILE), mmap_mode="r")
+        source_file_ids = np.load(os.path.join(folder, SOURCE_FILE_IDS_FILE), mmap_mode="r")
+    else:
+        source_offsets, source_file_ids = None, None
+    return Corpus(
+        MappedTexts(os.path.join(folder, TEXTS_FILE), offsets),
+        np.load(os.path.join(folder, FILE_IDS_FILE), mmap_mode="r"),
+        np.load(os.path.join(folder, NUM_WORDS_FILE), mmap_mode="r"),
+        files,
+        index=InvertedIndex.load(folder) if meta["index"] else None,
+        source_offsets=source_offsets,
+        source_file_ids=source_file_ids,
+        fingerprint=meta.get("fingerprint"),  # Missing in stores written before it was added
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds a memory-mapped corpus store from a folder of example files."
+    )
+    parser.add_argument("--corpus", type=str, required=True, help="Path to the corpus folder")
+    parser.add_argument("--out", type=str, required=True, help="Path to the output store folder")
+    parser.add_argument("--min_words", type=int, default=4, help="Minimum number of words of an example")
+    parser.add_argument("--max_words", type=int, default=15, help="Maximum number of words of an example")
+    parser.add_argument(
+        "--no_index", action="store_true", help="Don't store the inverted index"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes to read the files with"
+    )
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        default="exact",
+        choices=DEDUP_MODES,
+        help="Remove duplicate sentences across files, normalized ignores case and punctuation",
+    )
+    args = parser.parse_args()
+
+    corpus = prepare_corpus(
+        args.corpus, args.min_words, args.max_words, args.workers, args.dedup
+    )
+    write_corpus_store(corpus, args.out, build_index=not args.no_index)
+    print("Corpus store written to", args.out)
@@ -1,16 +1,19 @@
 from anki_utils.deck import load_deck, write_deck
-from find_examples import CorpusExamples
-from tqdm import tqdm
+from anki_examples.find_examples import CorpusExamples
+import os
+import random
 import signal
 import sys
 import pickle
 import shutil
 import argparse
+from typing import Optional
 
 
 deck = []
 metadata = []
 NA_FILLER = "None"
+DEFAULT_MODEL = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
 
 
 def save_examples(out_path):
@@ -21,6 +24,85 @@ def save_examples(out_path):
         sys.exit(1)
 
 
+def fill_deck_examples(
+    deck: list,
+    corpus: CorpusExamples,
+    num_examples: int,
+    embeddings: Optional[str] = None,
+    model: str = DEFAULT_MODEL,
+    nprobe: Optional[int] = None,
+    ex_sep: str = "|",
+):
+    """Fills the examples of the cards of a loaded deck up to `num_examples`, in place.
+
+    Only the field examples of the cards is changed.
+    With an embedding store, the examples closest in meaning to the Wiktionary gloss of each card are picked,
+    which reads its fields en and wiktdata, searching `nprobe` clusters of its ANN index.
+    Otherwise random examples are picked.
+    """
+    # Collect the cards that are missing examples, so the corpus is only searched once
+    cards_to_fill = []
+    for card in deck:
+        if card["examples"] == NA_FILLER:
+            continue
+
+        exs = card["examples"].strip()
+        existing_examples = list(set(exs.split(ex_sep))) if exs else []
+        num_ex_filled = len(existing_examples) if exs else 0
+
+        if num_ex_filled >= num_examples:
+            continue
+        cards_to_fill.append((card, existing_examples, num_examples - num_ex_filled))
+
+    print(f"Searching examples for {len(cards_to_fill)} cards...")
+    if embeddings:
+        from anki_examples.ann_index import IVF_FOLDER, IVFIndex, gloss_query
+        from anki_examples.notebooks.semantic_ranking import SimilarityRanker
+
+        ranker = SimilarityRanker(model)
+        store = ranker.open_store(embeddings, corpus.corpus)
+        ivf_folder = os.path.join(embeddings, IVF_FOLDER)
+        ann_index = (
+            IVFIndex.load(ivf_folder, store.embeddings)
+            if os.path.isdir(ivf_folder)
+            else None
+        )
+        found = corpus.find_examples_by_meaning(
+            [card["vi"] for card, _, _ in cards_to_fill],
+            [
+                gloss_query(card["wiktdata"], card["en"], card["vi"])
+                for card, _, _ in cards_to_fill
+            ],
+            num_examples=num_examples,
+            ranker=ranker,
+            store=store,
+            ann_index=ann_index,
+            nprobe=nprobe,
+        )
+    else:
+        found = corpus.find_examples_batch(
+            [card["vi"] for card, _, _ in cards_to_fill], num_examples=num_examples
+        )
+
+    for card, existing_examples, num_missing in cards_to_fill:
+        found_exs = found.get(card["vi"], [])
+        if len(found_exs) > num_missing:
+            # Examples ranked by meaning are sorted, so keep the best ones
+            found_exs = (
+                found_exs[:num_missing]
+                if embeddings
+                else random.sample(found_exs, num_missing)
+            )
+
+        if len(found_exs) == 0 and len(existing_examples) == 0:
+            card["examples"] = NA_FILLER
+            continue
+
+        card["examples"] = ex_sep.join(
+            existing_examples + [e["text"] for e in found_exs]
+        )
+
+
 def setup_signal_handler(out_path):
     def signal_handler(signal, frame):
         print("\n\nInterrupted. Saving progress...")
@@ -52,6 +134,33 @@ if __name__ == "__main__":
         default=20,
         help="Number of examples to fill each line",
     )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="auto",
+        choices=["auto", "scan", "index"],
+        help="Search backend: scan (GPU with cudf), index (CPU) or auto",
+    )
+    parser.add_argument(
+        "--embeddings",
+        type=str,
+        default=None,
+        help="Embedding store of the corpus (see ann_index.py). If given, the examples closest in meaning "
+        "to the Wiktionary gloss of each card are picked instead of random ones",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=DEFAULT_MODEL,
+        help="Sentence embedding model of the embedding store",
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=None,
+        help="Number of clusters of the ANN index to search with --embeddings, more is slower but finds "
+        "closer examples. Defaults to 5%% of the clusters, at least 8",
+    )
 
     args = parser.parse_args()
     csv_path = args.deck
@@ -64,7 +173,7 @@ if __name__ == "__main__":
         print("Error: Missing arguments")
         sys.exit(1)
 
-    corpus = CorpusExamples(args.corpus)
+    corpus = CorpusExamples(args.corpus, backend=args.backend)
 
     # backup the original file first
     shutil.copy(csv_path, csv_path + ".ex_bak")
@@ -74,33 +183,15 @@ if __name__ == "__main__":
     deck, metadata = load_deck(csv_path)
 
     try:
-        with tqdm(total=len(deck)) as pbar:
-            for card in deck:
-                if card["examples"] == NA_FILLER:
-                    pbar.update(1)
-                    continue
-                pbar.set_postfix(current=card["vi"])
-
-                exs = card["examples"].strip()
-                existing_examples = list(set(exs.split(ex_sep))) if exs else []
-                num_ex_filled = len(existing_examples) if exs else 0
-
-                pbar.update(1)
-
-                if num_ex_filled >= num_examples:
-                    continue
-
-                found_exs = corpus.find_examples(
-                    card["vi"], num_examples=num_examples - num_ex_filled
-                )
-                if len(found_exs) == 0 and num_ex_filled == 0:
-                    card["examples"] = NA_FILLER
-                    continue
-
-                card["examples"] = ex_sep.join(
-                    existing_examples + [e["text"] for e in found_exs]
-                )
-
+        fill_deck_examples(
+            deck,
+            corpus,
+            num_examples,
+            embeddings=args.embeddings,
+            model=args.model,
+            nprobe=args.nprobe,
+            ex_sep=ex_sep,
+        )
     except Exception as e:
         print("Error:", e)
         save_examples(out_path)
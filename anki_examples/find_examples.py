@@ -1,11 +1,27 @@
-import os
+import random
 import re
+from typing import Dict, List, Optional
+
 import numpy as np
-import cudf.pandas
+from tqdm import tqdm
+
+try:
+    import cudf.pandas
 
-cudf.pandas.install()  # Enable automatic conversion to cudf.DataFrame and memory sharing
+    cudf.pandas.install()  # Enable automatic conversion to cudf.DataFrame and memory sharing
+    CUDF_AVAILABLE = True
+except Exception:  # Not installed or no usable GPU, fall back to the CPU
+    CUDF_AVAILABLE = False
 
 import pandas as pd  # noqa: E402
+from anki_examples.corpus_index import TokenTrie, example_pattern, tokenize  # noqa: E402
+from anki_examples.corpus_store import (  # noqa: E402
+    Corpus,
+    is_corpus_store,
+    load_corpus_store,
+    prepare_corpus,
+)
+from anki_examples.search_backends import IndexBackend, select_backend  # noqa: E402
 
 
 class CorpusExamples:
@@ -14,43 +30,47 @@ class CorpusExamples:
         corpus_folder,
         min_words=4,
         max_words=15,
+        backend="auto",
+        dedup="exact",
     ):
-        self.corpus = self.prepare_corpus(corpus_folder)
-        print("Total Examples", sum([len(c[1]) for c in self.corpus]))
-        self.corpus_df: pd.DataFrame = pd.DataFrame(
-            self.corpus, columns=["file", "text"]
-        ).explode("text")
-
-        self.corpus_df["num_words"] = self.corpus_df["text"].str.count(" ") + 1
-        self.corpus_df = self.corpus_df[
-            (self.corpus_df["num_words"] >= min_words)
-            & (self.corpus_df["num_words"] <= max_words)
-        ]
-        print("Filtered Examples", len(self.corpus_df))
-
-    def prepare_corpus(self, corpus_folder):
-        """Prepare the corpus from the given folder.
-
-        Each file in the folder is a document in the corpus, with an example sentence for each line.
-        The corpus is a list of tuples with (file_name, file_content)."""
-
-        print("Preparing corpus from", corpus_folder)
-
-        def get_file(file_name):
-            with open(os.path.join(corpus_folder, file_name), "r") as f:
-                # Read each line and strip the newline character
-                return set([line.strip() for line in f.readlines()])
-
-        available_files = [fname for fname in os.listdir(corpus_folder)]
+        """
+        Parameters
+        ----------
+        corpus_folder : str
+            Folder with one file per document and one example sentence per line, or a corpus store
+            built with `corpus_store.py`, which is memory-mapped instead of read.
+        min_words : int
+            Minimum number of words of an example. For a corpus store, this was fixed when building it.
+        max_words : int
+            Maximum number of words of an example. For a corpus store, this was fixed when building it.
+        backend : str
+            How to search the examples: "scan" (regex over the whole corpus, on the GPU if cudf is installed),
+            "index" (inverted token index on the CPU) or "auto" to pick "scan" if cudf is available, else "index".
+        dedup : str
+            How to deduplicate the sentences across files: "none", "exact" or "normalized" (ignoring case and
+            punctuation). For a corpus store, this was fixed when building it.
+        """
+        if is_corpus_store(corpus_folder):
+            print("Loading corpus store from", corpus_folder)
+            self.corpus: Corpus = load_corpus_store(corpus_folder)
+            print("Examples", len(self.corpus))
+        else:
+            self.corpus = prepare_corpus(corpus_folder, min_words, max_words, dedup=dedup)
+        self._corpus_df: Optional[pd.DataFrame] = None
 
-        # Assumes openSubs format
-        corpus = [
-            (file_name.rsplit(".", 4)[0], get_file(file_name))
-            for file_name in available_files
-        ]
+        backend_cls = select_backend(backend, CUDF_AVAILABLE)
+        print("Search backend:", backend_cls.name)
+        if backend_cls is IndexBackend:
+            self.backend = IndexBackend(self.corpus.texts, self.corpus.index)
+        else:
+            self.backend = backend_cls(self.corpus_df)
 
-        print("Corpus prepared with", len(corpus), "files")
-        return np.array(corpus)
+    @property
+    def corpus_df(self) -> pd.DataFrame:
+        """The corpus as a DataFrame with the columns file, text and num_words, created on first use."""
+        if self._corpus_df is None:
+            self._corpus_df = self.corpus.to_dataframe()
+        return self._corpus_df
 
     def find_examples(self, example: str, num_examples: int):
         """
@@ -69,27 +89,159 @@ class CorpusExamples:
         Returns
         -------
         list
-            A list of dictionaries containing the found examples. Each dictionary represents a row in the DataFrame.
+            A list of dictionaries containing the found examples, with the keys file, text and num_words.
             If no examples are found or if the input parameters are invalid, an empty list is returned.
         """
         if not example or not num_examples:
             return []
 
-        ex_escaped = re.escape(example)
-
-        # cudf doesn't support case insensitive search, so we try lower case, upper case and title case
-        ex_pattern = rf"(^|\W)({ex_escaped.lower()}|{ex_escaped.title()}|{ex_escaped.upper()})($|\W)"
-
-        found_examples: pd.DataFrame = self.corpus_df[
-            self.corpus_df["text"].str.contains(ex_pattern)
-        ]
+        found_examples = self.backend.find(example)
 
         if len(found_examples) == 0:
             return []
         elif len(found_examples) <= num_examples:
-            return found_examples.to_dict(orient="records")
+            return self.corpus.records(found_examples)
         else:
-            return found_examples.sample(n=num_examples).to_dict(orient="records")
+            return self.corpus.records(random.sample(found_examples, num_examples))
+
+    def find_examples_batch(
+        self, examples: List[str], num_examples: int, seed: Optional[int] = None
+    ) -> Dict[str, List[dict]]:
+        """
+        Find examples for many example strings in a single pass over the corpus.
+
+        The token sequences of all example strings are put into a trie, so each sentence is tokenized once
+        and all example strings occurring in it are found together. The matches are then checked with the same
+        pattern as `find_examples` and sampled with reservoir sampling, so each example string gets a uniform
+        random sample of its matches like with `find_examples`.
+
+        Parameters
+        ----------
+        examples : List[str]
+            The example strings to search for in the corpus.
+        num_examples : int
+            The maximum number of examples to return per example string.
+        seed : int, optional
+            Seed for the random sampling.
+
+        Returns
+        -------
+        Dict[str, List[dict]]
+            The found examples for each example string, see `find_examples`.
+        """
+        examples = list(dict.fromkeys(ex for ex in examples if ex))
+        if not examples or not num_examples:
+            return {ex: [] for ex in examples}
+
+        trie = TokenTrie()
+        results: Dict[str, List[dict]] = {}
+        for ex in examples:
+            tokens = tokenize(ex)
+            if tokens:
+                trie.add(tokens, ex)
+            else:  # No tokens to match in the trie, e.g. only punctuation
+                results[ex] = self.find_examples(ex, num_examples)
+
+        patterns = {ex: re.compile(example_pattern(ex)) for ex in examples}
+        reservoirs: Dict[str, List[int]] = {ex: [] for ex in examples}
+        num_matches: Dict[str, int] = {ex: 0 for ex in examples}
+        rng = random.Random(seed)
+
+        for i, text in enumerate(tqdm(self.corpus.texts, desc="Searching the corpus")):
+            for ex in set(trie.find_all(tokenize(text))):
+                if not patterns[ex].search(text):
+                    continue
+                # Reservoir sampling (Algorithm R)
+                num_matches[ex] += 1
+                reservoir = reservoirs[ex]
+                if len(reservoir) < num_examples:
+                    reservoir.append(i)
+                else:
+                    j = rng.randrange(num_matches[ex])
+                    if j < num_examples:
+                        reservoir[j] = i
+
+        for ex, reservoir in reservoirs.items():
+            if ex in results:
+                continue
+            if num_matches[ex] > num_examples:  # Sampled, so return them in random order
+                rng.shuffle(reservoir)
+            results[ex] = self.corpus.records(reservoir)
+        return results
+
+    def find_examples_by_meaning(
+        self,
+        examples: List[str],
+        queries: List[str],
+        num_examples: int,
+        ranker,
+        store,
+        ann_index=None,
+        nprobe: Optional[int] = None,
+        ann_min_candidates: int = 1000,
+    ) -> Dict[str, List[dict]]:
+        """
+        Find the examples whose meaning is closest to a query, e.g. the Wiktionary gloss of the target sense.
+
+        For each example string, the sentences matching it like in `find_examples` are ranked by the similarity
+        of their embeddings to the query embedding in one vectorized pass. For example strings with many matches,
+        only the matches in the clusters of the ANN index closest to the query are ranked.
+
+        Parameters
+        ----------
+        examples : List[str]
+            The example strings to search for in the corpus.
+        queries : List[str]
+            The query of each example string, see `ann_index.gloss_query`.
+        num_examples : int
+            The maximum number of examples to return per example string.
+        ranker : SimilarityRanker
+            The model to encode the queries and the sentences missing in the store.
+        store : EmbeddingStore
+            The embedding store of this corpus, see `SimilarityRanker.open_store`.
+        ann_index : IVFIndex, optional
+            ANN index over the embeddings of the store, see `ann_index.py`.
+        nprobe : int, optional
+            Number of clusters of the ANN index to search, defaults to `IVFIndex.default_nprobe`.
+        ann_min_candidates : int
+            Only use the ANN index for example strings with more matches than this.
+
+        Returns
+        -------
+        Dict[str, List[dict]]
+            The found examples for each example string, the most similar first, see `find_examples`.
+        """
+        from anki_examples.notebooks.semantic_ranking import format_example
+
+        results: Dict[str, List[dict]] = {}
+        if not examples or not num_examples:
+            return {ex: [] for ex in examples}
+
+        query_enc = ranker.encode_numpy([format_example(q) for q in queries])
+        for ex, query in zip(tqdm(examples, desc="Ranking by meaning"), query_enc):
+            if not ex or ex in results:
+                continue
+            candidates = np.asarray(self.backend.find(ex), dtype=np.int64)
+
+            if ann_index is not None and len(candidates) > ann_min_candidates:
+                ids = np.intersect1d(
+                    ann_index.probe(query, nprobe), candidates, assume_unique=True
+                )
+                if len(ids) < num_examples:  # Too few matches near the query
+                    ids = candidates
+            else:
+                ids = candidates
+
+            if len(ids) == 0:
+                results[ex] = []
+                continue
+            texts = {
+                int(i): format_example(self.corpus.texts[i]) for i in store.missing(ids)
+            }
+            scores = ranker.embed_sentences(ids, texts, store) @ query
+            top = np.argsort(-scores, kind="stable")[:num_examples]
+            results[ex] = self.corpus.records(ids[top].tolist())
+        return results
 
 
 if __name__ == "__main__":
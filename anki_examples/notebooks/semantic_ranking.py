@@ -1,4 +1,7 @@
-from typing import List
+import json
+import os
+from typing import List, Optional, Sequence
+
 import torch
 import numpy as np
 from sentence_transformers import SentenceTransformer
@@ -14,6 +17,91 @@ def format_example(ex):
     return f"query: {ex}"
 
 
+class EmbeddingStore:
+    """
+    Persistent store of the normalized float16 embeddings of the corpus sentences, memory-mapped from disk.
+
+    The embeddings are indexed by sentence id, the position of the sentence in the corpus, so each sentence only
+    has to be encoded once across runs. The embedding of id `i` is the one of `format_example(corpus.texts[i])`.
+    Sentences that were not encoded yet are marked in the `encoded` mask.
+
+    The store is only valid for the exact corpus it was built for, so a store of another model, text format or
+    corpus fingerprint is rejected, e.g. after the corpus store was rebuilt with another dedup mode.
+
+    Args:
+        folder (str): The folder of the store. It is created if it does not exist.
+        num_sentences (int): The number of sentences of the corpus.
+        dim (int): The dimension of the embeddings.
+        model_name (str): The model the embeddings are from.
+        corpus_fingerprint (str): The fingerprint of the corpus texts, see `Corpus.fingerprint`.
+    """
+
+    META_FILE = "embedding_store.json"
+    EMBEDDINGS_FILE = "embeddings.npy"
+    ENCODED_FILE = "encoded.npy"
+
+    def __init__(
+        self,
+        folder: str,
+        num_sentences: int,
+        dim: int,
+        model_name: str,
+        corpus_fingerprint: str,
+    ):
+        self.folder = folder
+        meta = {
+            "model_name": model_name,
+            "num_sentences": num_sentences,
+            "dim": dim,
+            "text_format": format_example(""),
+            "corpus_fingerprint": corpus_fingerprint,
+        }
+        meta_path = os.path.join(folder, self.META_FILE)
+        embeddings_path = os.path.join(folder, self.EMBEDDINGS_FILE)
+        encoded_path = os.path.join(folder, self.ENCODED_FILE)
+
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                stored_meta = json.load(f)
+            if stored_meta != meta:
+                raise ValueError(
+                    f"Embedding store {folder} was built for {stored_meta}, not {meta}. "
+                    "Delete it or use another folder to encode the corpus again."
+                )
+            self.embeddings = np.load(embeddings_path, mmap_mode="r+")
+            self.encoded = np.load(encoded_path, mmap_mode="r+")
+        else:
+            os.makedirs(folder, exist_ok=True)
+            self.embeddings = np.lib.format.open_memmap(
+                embeddings_path, mode="w+", dtype=np.float16, shape=(num_sentences, dim)
+            )
+            self.encoded = np.lib.format.open_memmap(
+                encoded_path, mode="w+", dtype=np.bool_, shape=(num_sentences,)
+            )
+            # The meta file is written last, so an interrupted creation is redone
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+    def __len__(self) -> int:
+        return len(self.encoded)
+
+    def missing(self, ids: np.ndarray) -> np.ndarray:
+        """Returns the unique ids that are not encoded yet."""
+        ids = np.unique(ids)
+        return ids[~self.encoded[ids]]
+
+    def add(self, ids: np.ndarray, embeddings: np.ndarray):
+        self.embeddings[ids] = embeddings.astype(np.float16)
+        self.encoded[ids] = True
+
+    def get(self, ids: np.ndarray) -> np.ndarray:
+        return self.embeddings[ids]
+
+    def flush(self):
+        self.embeddings.flush()
+        self.encoded.flush()
+
+
 class SimilarityRanker:
     """
     Class for ranking examples based on their similarity to a given query.
@@ -21,7 +109,7 @@ class SimilarityRanker:
     Args:
         model_name (str): The name of the pre-trained model to use for encoding the texts.
         batch_size (int): The batch size to use for encoding the texts.
-        device (str): The device to use for encoding the texts.
+        device (str): The device to use for encoding the texts, defaults to the GPU if available.
 
     Attributes:
         model (SentenceTransformer): The SentenceTransformer model used for encoding the texts.
@@ -33,12 +121,34 @@ class SimilarityRanker:
         self,
         model_name="sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
         batch_size=32,
-        device="cuda",
+        device=None,
     ):
-        self.model: SentenceTransformer = SentenceTransformer(model_name).to("cuda")
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model_name = model_name
+        self.model: SentenceTransformer = SentenceTransformer(model_name, device=device)
         self.batch_size = batch_size
         self.device = device
 
+    @property
+    def dim(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def open_store(self, folder: str, corpus) -> EmbeddingStore:
+        """
+        Open or create the embedding store of a corpus for this model.
+
+        Args:
+            folder (str): The folder of the store.
+            corpus (Corpus): The corpus, see `corpus_store.py`. The ids of the store are its sentence positions.
+
+        Returns:
+            EmbeddingStore: The store, to pass to `embed_sentences`, `sort` and `sort_batch`.
+        """
+        return EmbeddingStore(
+            folder, len(corpus), self.dim, self.model_name, corpus.fingerprint
+        )
+
     def encode(self, texts):
         """
         Encode a list of texts into their corresponding embeddings.
@@ -58,7 +168,54 @@ class SimilarityRanker:
             normalize_embeddings=True,
         )
 
-    def sort(self, vi: str, examples: List[str], key=lambda x: x):
+    def encode_numpy(self, texts) -> np.ndarray:
+        """
+        Encode a list of texts into normalized float32 embeddings on the CPU.
+
+        Args:
+            texts (List[str]): The list of texts to encode.
+
+        Returns:
+            np.ndarray: The encoded embeddings, one row per text.
+        """
+        return self.model.encode(
+            list(texts),
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            device=self.device,
+            normalize_embeddings=True,
+        ).astype(np.float32)
+
+    def embed_sentences(
+        self, ids: Sequence[int], texts: Sequence[str], store: EmbeddingStore
+    ) -> np.ndarray:
+        """
+        Get the embeddings of corpus sentences, only encoding the ones that are not in the store yet.
+
+        Args:
+            ids (Sequence[int]): The ids of the sentences in the store.
+            texts (Sequence[str]): The texts to encode, indexable by id. Must be the texts of the corpus
+                mapped with `format_example`, as the store is shared by all callers.
+            store (EmbeddingStore): The embedding store of the corpus.
+
+        Returns:
+            np.ndarray: The float32 embeddings of the sentences, in the order of `ids`.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        missing = store.missing(ids)
+        if len(missing):
+            store.add(missing, self.encode_numpy([texts[i] for i in missing]))
+            store.flush()
+        return store.get(ids).astype(np.float32)
+
+    def sort(
+        self,
+        vi: str,
+        examples: List[str],
+        key=lambda x: x,
+        ids: Optional[Sequence[int]] = None,
+        store: Optional[EmbeddingStore] = None,
+    ):
         """
         Sort a list of examples based on their similarity to a given query.
 
@@ -66,10 +223,15 @@ class SimilarityRanker:
             vi (str): The query text.
             examples (List[str]): The list of examples to sort.
             key (function): The key function to apply to each example before computing similarity.
+            ids (Sequence[int], optional): The corpus ids of the examples, to take their embeddings from the store.
+            store (EmbeddingStore, optional): The embedding store of the corpus, used together with `ids`.
 
         Returns:
             np.ndarray: The sorted examples.
         """
+        if store is not None and ids is not None:
+            return self.sort_batch([vi], [examples], key=key, ids=[ids], store=store)[0]
+
         all_enc = self.encode([vi] + [key(ex) for ex in examples])
         query_enc, examples_enc = all_enc[0], all_enc[1:]
         similarities = torch.cosine_similarity(query_enc[None], examples_enc, dim=1)
@@ -77,3 +239,75 @@ class SimilarityRanker:
             torch.argsort(similarities, descending=True).cpu().detach().numpy()
         )
         return np.array(examples)[sorted_indices]
+
+    def sort_batch(
+        self,
+        queries: List[str],
+        examples: List[List],
+        key=lambda x: x,
+        ids: Optional[List[Sequence[int]]] = None,
+        store: Optional[EmbeddingStore] = None,
+        max_scores: int = 2**26,
+    ):
+        """
+        Sort the examples of many queries, e.g. the found examples of all words of a deck, at once.
+
+        All queries and all distinct examples are encoded in one call each, and the similarities are computed
+        with one matrix multiply per chunk of queries, bounded by `max_scores` entries.
+
+        Args:
+            queries (List[str]): The query texts.
+            examples (List[List]): The examples of each query.
+            key (function): The key function to apply to each example before computing similarity.
+            ids (List[Sequence[int]], optional): The corpus ids of the examples of each query. With a store, the
+                examples are deduplicated by id and their embeddings are cached in the store, so `key` must map
+                an example to `format_example` of its corpus text.
+            store (EmbeddingStore, optional): The embedding store of the corpus, used together with `ids`.
+            max_scores (int): The maximum size of the similarity matrix of a chunk.
+
+        Returns:
+            List[np.ndarray]: The sorted examples of each query.
+        """
+        if not queries:
+            return []
+        query_enc = self.encode_numpy(queries)
+
+        # Deduplicate the examples over all queries, rows[i] maps the examples of query i to `examples_enc`
+        if store is not None and ids is not None:
+            flat_ids = np.concatenate(
+                [np.asarray(i, dtype=np.int64) for i in ids] + [np.empty(0, np.int64)]
+            )
+            unique_ids, flat_rows = np.unique(flat_ids, return_inverse=True)
+            texts = {
+                i: key(ex)
+                for q_ids, q_examples in zip(ids, examples)
+                for i, ex in zip(q_ids, q_examples)
+            }
+            examples_enc = self.embed_sentences(unique_ids, texts, store)
+        else:
+            unique_texts = {}
+            flat_rows = np.array(
+                [
+                    unique_texts.setdefault(key(ex), len(unique_texts))
+                    for q_examples in examples
+                    for ex in q_examples
+                ],
+                dtype=np.int64,
+            )
+            examples_enc = (
+                self.encode_numpy(list(unique_texts))
+                if unique_texts
+                else np.empty((0, query_enc.shape[1]), dtype=np.float32)
+            )
+        splits = np.cumsum([len(q_examples) for q_examples in examples])[:-1]
+        rows = np.split(flat_rows, splits)
+
+        results = []
+        chunk_size = max(1, max_scores // max(len(examples_enc), 1))
+        for start in range(0, len(queries), chunk_size):
+            # Cosine similarity, as the embeddings are normalized
+            similarities = query_enc[start : start + chunk_size] @ examples_enc.T
+            for i, q_similarities in enumerate(similarities, start):
+                sorted_indices = np.argsort(-q_similarities[rows[i]], kind="stable")
+                results.append(np.array(examples[i])[sorted_indices])
+        return results
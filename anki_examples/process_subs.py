@@ -1,13 +1,17 @@
-from tqdm import tqdm
-import pandas as pd
+import argparse
+import json
+import multiprocessing
 import os
+import time
 import zipfile
-import regex
-from wtpsplit import WtP
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional, Tuple
 
+from tqdm import tqdm
+from anki_examples.segmenters import SEGMENTERS, get_segmenter
+from anki_examples.srt_parser import read_srt
 
-def check_if_file_exists_in_output_folder(file_name):
-    return file_name in output_files
+MANIFEST_FILE = "manifest.jsonl"
 
 
 def get_sub_list(subs_folder):
@@ -31,6 +35,10 @@ def get_sub_list(subs_folder):
     return sorted(list(subs_list))
 
 
+def output_file_name(zip_file: str) -> str:
+    return os.path.splitext(os.path.basename(zip_file))[0] + ".txt"
+
+
 def find_srt_name(zip_ref):
     for file in zip_ref.namelist():
         if file.endswith(".srt"):
@@ -38,77 +46,306 @@ def find_srt_name(zip_ref):
     return None
 
 
-def find_line_endings(txt):
-    if "\r\n" in txt[:100]:
-        return "\r\n\r\n"
-    else:
-        return "\n\n"
+def read_subtitle(zip_file: str) -> str:
+    """Reads the SRT file of a subtitle zip and returns its cleaned text, with the cues joined by spaces.
 
+    This is the CPU bound part of the pipeline and runs in the worker processes.
+    """
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        srt_name = find_srt_name(zip_ref)
+        if not srt_name:
+            raise ValueError("SRT file not found in the zip file.")
+        with zip_ref.open(srt_name) as srt_file:
+            return " ".join(read_srt(srt_file))
 
-def process_zip_file(zip_file, wtp):
-    out_file_name = os.path.splitext(os.path.basename(zip_file))[0] + ".txt"
-    out_path = os.path.join(output_folder, out_file_name)
 
-    if check_if_file_exists_in_output_folder(out_file_name):
-        print("File already processed: ", out_file_name)
-        return None
+def write_sentences(out_path: str, sentences: List[str]):
+    """Writes one sentence per line, replacing the file atomically so there are no partial outputs."""
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(sentences))
+    os.replace(tmp_path, out_path)
 
-    def process_line(line, seperator):
-        line_split = line.split(seperator)
-        if len(line_split) < 3:
-            return ""
-        _, _, src = line.split(seperator)[:3]
-        processed = src.strip(" -\n\r\t")  # Trailing chars
-        processed = regex.sub(r"<[^>]*?>", "", processed)  # Remove HTML tags
-        processed = regex.sub(
-            r"[^\p{L}\p{N}\p{P}\p{Z}]", "", processed
-        )  # Remove non-letter, non-number, non-punctuation, non-separator chars
 
-        return processed
+class SubsManifest:
+    """Append-only log of the processed and failed subtitle files, one JSON object per line.
 
-    with zipfile.ZipFile(zip_file, "r") as zip_ref:
-        srt_name = find_srt_name(zip_ref)
-        if srt_name:
-            with zip_ref.open(srt_name) as srt_file:
-                contents = srt_file.read().decode("utf-8", errors="ignore")
-                line_endings = find_line_endings(contents)
-                contents_parsed = [
-                    process_line(line, line_endings[:2])
-                    for line in contents.split(line_endings)
-                ]
-        else:
-            print("SRT file not found in the zip file.")
-            return None
-
-    content_text_only = " ".join(contents_parsed)
-    splits = wtp.split(content_text_only, lang_code="vi")
-
-    # write to csv file with the same name
-    with open(out_path, "w") as f:
-        f.write("\n".join(splits))
-    print("processed file: ", out_path)
+    Each line is written and flushed to disk as soon as a file is done, so an interrupted run can be resumed
+    without processing any file twice. If a file appears several times, the last entry counts.
 
+    Parameters
+    ----------
+    path : str
+        Path to the manifest. It is created if it does not exist.
+    """
 
-if __name__ == "__main__":
-    subs_folder = "/media/ducha/SSDSHARED/VN/subs_dump/viet_subs_raw/viet_subs"
-    output_folder = "/media/ducha/SSDSHARED/VN/subs_dump/viet_subs_processed2"
+    def __init__(self, path: str):
+        self.path = path
+        self.status: Dict[str, dict] = {}
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:  # Line cut off by a crash
+                        continue
+                    self.status[entry["file"]] = entry
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __contains__(self, file_name: str) -> bool:
+        return file_name in self.status
+
+    def done(self) -> List[str]:
+        return [f for f, entry in self.status.items() if entry["status"] == "done"]
+
+    def failed(self) -> Dict[str, str]:
+        """Returns the error message of each failed file."""
+        return {
+            f: entry["error"]
+            for f, entry in self.status.items()
+            if entry["status"] == "failed"
+        }
+
+    def _append(self, entry: dict):
+        self.status[entry["file"]] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def mark_done(self, file_name: str, num_sentences: int):
+        self._append(
+            {"file": file_name, "status": "done", "sentences": num_sentences}
+        )
+
+    def mark_failed(self, file_name: str, error: str):
+        self._append({"file": file_name, "status": "failed", "error": error})
+
+    def close(self):
+        self._file.close()
+
+
+def read_subtitles(
+    zip_files: List[str], workers: int, max_pending: int
+) -> Iterable[Tuple[str, Optional[str], Optional[Exception]]]:
+    """Reads the subtitle zips in a process pool and yields (zip_file, text, error) as they are done.
+
+    At most `max_pending` files are read ahead, so the memory stays bounded if the segmentation is slower.
+    The workers are spawned so they don't inherit the segmentation model or its CUDA context.
+    """
+    zip_files = iter(zip_files)
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        pending = {}
+        while True:
+            for zip_file in zip_files:
+                pending[executor.submit(read_subtitle, zip_file)] = zip_file
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                zip_file = pending.pop(future)
+                try:
+                    yield zip_file, future.result(), None
+                except Exception as e:
+                    yield zip_file, None, e
+
+
+def process_subs(
+    subs_folder: str,
+    output_folder: str,
+    segmenter,
+    manifest_path: Optional[str] = None,
+    workers: Optional[int] = None,
+    files_per_batch: int = 32,
+    retry_failed: bool = False,
+):
+    """Converts the subtitle zips of the folder into text files with one sentence per line.
+
+    The zips are read and cleaned in a process pool, while the sentences of `files_per_batch` files at a time are
+    segmented in a single model call. Each file is recorded in the manifest when its output is written, so the
+    processing can be interrupted and resumed.
+
+    Parameters
+    ----------
+    subs_folder : str
+        Folder with the OpenSubtitles zips.
+    output_folder : str
+        Folder to write the text files to.
+    segmenter : WtpSegmenter | RuleSegmenter
+        The sentence segmentation backend, see `segmenters.py`.
+    manifest_path : str, optional
+        Path to the manifest of processed files, defaults to `manifest.jsonl` in the output folder.
+        When it is created, the text files already in the output folder are recorded as done.
+    workers : int, optional
+        Number of processes to read the zips with, defaults to the number of CPUs.
+    files_per_batch : int
+        Number of files to segment together.
+    retry_failed : bool
+        Process the files that failed in a previous run again.
+    """
     os.makedirs(output_folder, exist_ok=True)
-    # Treat files in output_folder as cache
-    output_files = set(os.listdir(output_folder))
+    manifest_path = manifest_path or os.path.join(output_folder, MANIFEST_FILE)
+    is_new_manifest = not os.path.exists(manifest_path)
+    manifest = SubsManifest(manifest_path)
+    if is_new_manifest:
+        # Output folders of previous versions of this script have no manifest
+        for out_file_name in os.listdir(output_folder):
+            if out_file_name.endswith(".txt"):
+                manifest.mark_done(out_file_name, -1)
+
+    failed = manifest.failed()
+    subs_list = [
+        file
+        for file in get_sub_list(subs_folder)
+        if output_file_name(file) not in manifest
+        or (retry_failed and output_file_name(file) in failed)
+    ]
+    print("Files to process:", len(subs_list), "already in manifest:", len(manifest.status))
 
-    subs_list = get_sub_list(subs_folder)
+    workers = workers or os.cpu_count() or 1
+    zip_paths = [os.path.join(subs_folder, file) for file in subs_list]
+    batch: List[Tuple[str, str]] = []
+    num_failed = 0
 
-    wtp = WtP("wtp-bert-mini")
-    wtp.to("cuda")
+    def mark_failed(out_file_name: str, error: Exception):
+        nonlocal num_failed
+        print("Error processing file: ", out_file_name, error)
+        manifest.mark_failed(out_file_name, str(error))
+        num_failed += 1
 
-    with open("error_files.txt", "w+") as ef:
-        with tqdm(total=len(subs_list)) as pbar:
-            for file in tqdm(subs_list):
+    def segment_batch():
+        done = 0
+        try:
+            splits = segmenter.split([text for _, text in batch])
+            for (out_file_name, _), sentences in zip(batch, splits):
+                write_sentences(os.path.join(output_folder, out_file_name), sentences)
+                manifest.mark_done(out_file_name, len(sentences))
+                done += 1
+        except Exception:
+            # Segment the rest one file at a time, so only the files that fail are recorded as failed
+            for out_file_name, text in batch[done:]:
                 try:
-                    process_zip_file(os.path.join(subs_folder, file), wtp)
-                    pbar.set_postfix({"status": "O"})
+                    sentences = list(segmenter.split([text]))[0]
+                    write_sentences(os.path.join(output_folder, out_file_name), sentences)
+                    manifest.mark_done(out_file_name, len(sentences))
                 except Exception as e:
-                    print("Error processing file: ", file)
-                    ef.write(file + "\n" + str(e) + "\n\n")
-                    pbar.set_postfix({"status": "X"})
-                pbar.update(1)
+                    mark_failed(out_file_name, e)
+        batch.clear()
+
+    start = time.time()
+    try:
+        with tqdm(total=len(zip_paths)) as pbar:
+            for zip_file, text, error in read_subtitles(
+                zip_paths, workers, max_pending=max(2 * files_per_batch, 2 * workers)
+            ):
+                if error is not None:
+                    mark_failed(output_file_name(zip_file), error)
+                    pbar.set_postfix({"failed": num_failed})
+                    pbar.update(1)
+                    continue
+
+                batch.append((output_file_name(zip_file), text))
+                if len(batch) >= files_per_batch:
+                    pbar.update(len(batch))
+                    segment_batch()
+                    pbar.set_postfix({"failed": num_failed})
+            if batch:
+                pbar.update(len(batch))
+                segment_batch()
+    finally:
+        manifest.close()
+
+    print(
+        f"Processed {len(zip_paths) - num_failed} files in {time.time() - start:.0f}s,",
+        num_failed,
+        "failed",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert OpenSubtitles zips into text files with one sentence per line."
+    )
+    parser.add_argument(
+        "--subs",
+        default="/media/ducha/SSDSHARED/VN/subs_dump/viet_subs_raw/viet_subs",
+        help="Folder with the subtitle zips",
+    )
+    parser.add_argument(
+        "--out",
+        default="/media/ducha/SSDSHARED/VN/subs_dump/viet_subs_processed2",
+        help="Folder to write the sentences to",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        help=f"Manifest of the processed files, defaults to {MANIFEST_FILE} in the output folder",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes to read the zips with, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--files_per_batch",
+        type=int,
+        default=32,
+        help="Number of files to segment in one model call",
+    )
+    parser.add_argument(
+        "--segmenter",
+        choices=list(SEGMENTERS),
+        default="wtp",
+        help="Sentence segmentation backend: the WtP model or the rule based splitter",
+    )
+    parser.add_argument(
+        "--model", default="wtp-bert-mini", help="Name of the WtP model"
+    )
+    parser.add_argument(
+        "--device",
+        choices=["auto", "cpu", "cuda"],
+        default="auto",
+        help="Device of the WtP model, auto uses the GPU if available",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=32, help="Batch size of the model"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Number of threads of the model on the CPU, leave some cores to the --workers",
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="Process the files that failed in a previous run again",
+    )
+    args = parser.parse_args()
+
+    if args.segmenter == "wtp":
+        segmenter = get_segmenter(
+            args.segmenter,
+            model=args.model,
+            device=args.device,
+            batch_size=args.batch_size,
+            threads=args.threads,
+        )
+    else:
+        segmenter = get_segmenter(args.segmenter)
+
+    process_subs(
+        args.subs,
+        args.out,
+        segmenter,
+        manifest_path=args.manifest,
+        workers=args.workers,
+        files_per_batch=args.files_per_batch,
+        retry_failed=args.retry_failed,
+    )
@@ -0,0 +1,74 @@
+import re
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from anki_examples.corpus_index import InvertedIndex, example_pattern
+
+
+class ScanBackend:
+    """Searches the examples with a vectorized regex over the whole text column.
+
+    This runs on the GPU if `cudf.pandas` was installed before importing pandas, otherwise on the CPU.
+    """
+
+    name = "scan"
+
+    def __init__(self, corpus_df: pd.DataFrame):
+        self.corpus_df = corpus_df
+
+    def find(self, example: str) -> List[int]:
+        """Returns the positions of the sentences in `corpus_df` that match the example."""
+        mask = self.corpus_df["text"].str.contains(example_pattern(example))
+        return np.flatnonzero(np.asarray(mask)).tolist()
+
+
+class IndexBackend:
+    """Searches the examples with an inverted token index, which is fast on the CPU.
+
+    Only the sentences that contain all tokens of the example are checked with the regex.
+
+    Parameters
+    ----------
+    texts : Sequence[str]
+        The sentences of the corpus.
+    index : InvertedIndex, optional
+        A prebuilt index over the texts, e.g. from a corpus store. Built from the texts if not given.
+    """
+
+    name = "index"
+
+    def __init__(self, texts: Sequence[str], index: Optional[InvertedIndex] = None):
+        self.texts = texts
+        if index is None:
+            print("Building the inverted index...")
+            index = InvertedIndex(texts)
+        self.index = index
+        print("Indexed Tokens", len(self.index))
+
+    def find(self, example: str) -> List[int]:
+        """Returns the positions of the sentences in the texts that match the example."""
+        ex_regex = re.compile(example_pattern(example))
+
+        candidates = self.index.candidates(example)
+        if candidates is None:  # No tokens to look up, e.g. only punctuation
+            return [i for i, text in enumerate(self.texts) if ex_regex.search(text)]
+        # Check the word boundaries on the candidates only
+        return [int(i) for i in candidates if ex_regex.search(self.texts[i])]
+
+
+BACKENDS = {backend.name: backend for backend in [ScanBackend, IndexBackend]}
+
+
+def select_backend(name: str, cudf_available: bool):
+    """Returns the backend class for the given name.
+
+    "auto" selects the scan backend if cudf is available, as it runs on the GPU, and the index otherwise.
+    """
+    if name == "auto":
+        name = ScanBackend.name if cudf_available else IndexBackend.name
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown backend {name}, choose one of {['auto', *BACKENDS]}"
+        )
+    return BACKENDS[name]
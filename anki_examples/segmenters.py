@@ -0,0 +1,108 @@
+from typing import Iterator, List, Optional
+
+import regex
+
+# Sentence end punctuation with closing quotes/brackets, followed by the start of a new sentence
+SENTENCE_BOUNDARY_REGEX = regex.compile(
+    r"[.!?…]+[\"'”’»)\]]*\s+(?=(?:[-–]\s*)?[\"'“‘«(\[]*[\p{Lu}\p{N}])"
+)
+# A period after these doesn't end the sentence
+ABBREVIATIONS = {
+    "bs", "dr", "gs", "mr", "mrs", "ms", "pgs", "st", "th", "ths", "tp", "ts", "vs",
+}  # fmt: skip
+
+
+class RuleSegmenter:
+    """Splits at sentence end punctuation followed by an upper case letter or digit.
+
+    Much faster than the model and needs no GPU, but misses the sentence boundaries without punctuation,
+    which are common in subtitles where each cue is a sentence.
+    """
+
+    name = "rules"
+
+    def split_text(self, text: str) -> List[str]:
+        sentences = []
+        start = 0
+        for match in SENTENCE_BOUNDARY_REGEX.finditer(text):
+            if text.startswith(".", match.start()) and not text.startswith("..", match.start()):
+                # Look at the word before a single period, but only in a small window for linear time
+                words = text[max(start, match.start() - 8) : match.start()].split()
+                word = words[-1] if words else ""
+                if word.lower() in ABBREVIATIONS or (len(word) == 1 and word.isupper()):
+                    continue
+            sentence = text[start : match.end()].strip()
+            if not any(c.isalnum() for c in sentence):  # Only punctuation, e.g. a leading ellipsis
+                continue
+            sentences.append(sentence)
+            start = match.end()
+
+        sentence = text[start:].strip()
+        if sentence:
+            sentences.append(sentence)
+        return sentences
+
+    def split(self, texts: List[str]) -> Iterator[List[str]]:
+        """Yields the sentences of each text."""
+        return (self.split_text(text) for text in texts)
+
+
+class WtpSegmenter:
+    """Splits with a WtP sentence segmentation model, batching the inputs of all texts.
+
+    Parameters
+    ----------
+    model : str
+        Name of the WtP model.
+    device : str
+        "cuda", "cpu" or "auto" to use the GPU if available.
+    batch_size : int
+        Batch size of the model. On the CPU, smaller batches are usually faster.
+    threads : int, optional
+        Number of threads for the model on the CPU, defaults to the torch default (number of cores).
+        Lower it to leave cores to the processes reading the subtitles.
+    lang_code : str
+        Language of the texts for the language adapter.
+    """
+
+    name = "wtp"
+
+    def __init__(
+        self,
+        model: str = "wtp-bert-mini",
+        device: str = "auto",
+        batch_size: int = 32,
+        threads: Optional[int] = None,
+        lang_code: str = "vi",
+    ):
+        import torch
+        from wtpsplit import WtP
+
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if threads:
+            torch.set_num_threads(threads)
+
+        self.device = device
+        self.batch_size = batch_size
+        self.lang_code = lang_code
+        self.wtp = WtP(model)
+        self.wtp.to(device)
+
+    def split(self, texts: List[str]) -> Iterator[List[str]]:
+        """Yields the sentences of each text, all texts are segmented in one model call."""
+        return self.wtp.split(
+            texts, lang_code=self.lang_code, batch_size=self.batch_size
+        )
+
+
+SEGMENTERS = {segmenter.name: segmenter for segmenter in [WtpSegmenter, RuleSegmenter]}
+
+
+def get_segmenter(name: str, **kwargs):
+    """Creates the segmenter with the given name, the keyword arguments are only passed to the WtP segmenter."""
+    if name not in SEGMENTERS:
+        raise ValueError(f"Unknown segmenter {name}, choose one of {list(SEGMENTERS)}")
+    if name == WtpSegmenter.name:
+        return WtpSegmenter(**kwargs)
+    return SEGMENTERS[name]()
@@ -0,0 +1,56 @@
+import io
+from typing import IO, Iterable, Iterator, List
+
+import regex
+
+TIMING_REGEX = regex.compile(r"^\s*\d+:\d+:\d+[,.]\d+\s*-->")
+TAG_REGEX = regex.compile(r"<[^>]*?>|\{\\[^}]*\}")  # HTML and ASS style tags
+# Non-letter, non-number, non-punctuation, non-separator chars
+INVALID_CHARS_REGEX = regex.compile(r"[^\p{L}\p{N}\p{P}\p{Z}]")
+STRIP_CHARS = " -\n\r\t﻿"  # Trailing chars and dialogue dashes
+
+
+def clean_line(line: str) -> str:
+    """Removes tags, symbols like music notes and dialogue dashes from a subtitle line."""
+    # Tags first, so the dashes inside of them, like in <i>- Xin chào.</i>, are stripped as well
+    line = INVALID_CHARS_REGEX.sub("", TAG_REGEX.sub("", line))
+    return line.strip(STRIP_CHARS)
+
+
+def iter_srt_text(lines: Iterable[str]) -> Iterator[str]:
+    """Parses SRT lines and yields the cleaned text of each cue, with its lines joined by spaces.
+
+    Cues are a timing line followed by text lines up to an empty line. Everything outside of the cues, like the
+    cue numbers, is skipped. A cue number directly after the text of the previous cue, without an empty line in
+    between, is recognized and dropped as well.
+    """
+    text: List[str] = []
+    in_cue = False
+    for line in lines:
+        if TIMING_REGEX.match(line):
+            if text and text[-1].isdigit():  # Number of this cue, missing the empty line before it
+                text.pop()
+            if text:
+                yield " ".join(text)
+            text = []
+            in_cue = True
+        elif not line.strip():
+            if text:
+                yield " ".join(text)
+            text = []
+            in_cue = False
+        elif in_cue:
+            cleaned = clean_line(line)
+            if cleaned:
+                text.append(cleaned)
+    if text:
+        yield " ".join(text)
+
+
+def read_srt(srt_file: IO[bytes]) -> Iterator[str]:
+    """Streams the cue texts of a binary SRT file, e.g. a zip member, without reading it into memory at once.
+
+    Undecodable bytes are ignored, and any mix of \\n, \\r\\n and \\r line endings is handled.
+    """
+    lines = io.TextIOWrapper(srt_file, encoding="utf-8", errors="ignore", newline=None)
+    return iter_srt_text(lines)
@@ -1,4 +1,5 @@
 import csv
+import os
 
 
 def load_deck(deck_csv_path: str) -> tuple[list[dict], list[str]]:
@@ -85,8 +86,11 @@ def write_deck(deck: list[dict], metadata: list[str], out_path: str):
     None
         A CSV file at the specified out_path with the provided deck and metadata.
         The CSV file will use tab as the delimiter and will not quote any fields.
+        The file is replaced atomically.
     """
-    with open(out_path, "w", newline="", encoding="utf-8") as csv_file:
+    # Write to a temporary file first, so an interrupted write never leaves a truncated deck
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as csv_file:
         fieldnames = ["id", "vi", "en", "examples", "wiktdata", "tag"]
         writer = csv.DictWriter(
             csv_file,
@@ -104,5 +108,6 @@ def write_deck(deck: list[dict], metadata: list[str], out_path: str):
             #     # Escape backslashes in wiktdata
             #     note_dict["wiktdata"] = note_dict["wiktdata"].replace("\\\\", "")
             writer.writerow(note_dict)
+    os.replace(tmp_path, out_path)
 
     print(f"Writing deck to {out_path}")
@@ -1,29 +1,52 @@
 import argparse
+import json
 import os
 import re
+from functools import lru_cache
 from typing import Optional
 
 import torch
-from flask import Flask, request, send_from_directory
+from flask import Flask, Response, request, send_from_directory, stream_with_context
 from transformers import pipeline
 from wiktionary_defs.fill_with_wikt import (
-    get_entries,
+    get_entry_records,
     json_dump_entries,
-    load_wiktextract,
 )
+from wiktionary_defs.wikt_index import HeadwordTrie, normalize_headword
+from wiktionary_defs.wikt_store import load_wiktionary_index
 from anki_utils.deck import load_deck
+from serving import AudioJobQueue, BatchingTranscriber, ServerBusy, serve
+from streaming import SessionTooLarge, StreamingTranscriber
 import pandas as pd
 
 
+def ngrams(words: list[str], max_n: int) -> list[str]:
+    """Returns the distinct n-grams of the words up to length `max_n`, ordered by length and then position."""
+    return list(
+        dict.fromkeys(
+            " ".join(words[j : j + n])
+            for n in range(1, max_n + 1)
+            for j in range(len(words) - n + 1)
+        )
+    )
+
+
 class TranscriptionProcessor:
     def __init__(
         self,
         wikt_path: str,
         model_name: str = "vinai/PhoWhisper-medium",
         deck_path: Optional[str] = None,
+        wikt_cache_dir: Optional[str] = None,
+        cache_size: int = 4096,
+        warm_cache: bool = False,
     ):
+        # Cache of the serialized entries per normalized word, per instance so it is freed with the processor
+        self._cached_wikt_entry = lru_cache(maxsize=cache_size)(self._build_wikt_entry)
+
         print("Loading Wiktionary data...")
-        self.wikt_df = load_wiktextract(wikt_path)
+        self.wikt_index = load_wiktionary_index(wikt_path, cache_dir=wikt_cache_dir)
+        self.headword_trie = HeadwordTrie.from_index(self.wikt_index)
 
         print(f"Loading the transcriber model {model_name}...")
         self.transcriber = pipeline(
@@ -31,60 +54,83 @@ class TranscriptionProcessor:
             model=model_name,
             device="cuda" if torch.cuda.is_available() else "cpu",
         )
-        # self.sampling_rate = self.transcriber.feature_extractor.sampling_rate
+        self.sampling_rate = self.transcriber.feature_extractor.sampling_rate
         self.deck_df: pd.DataFrame | None = None
+        self.deck_words: set[str] = set()
         if deck_path is not None:
             print(f"Loading Deck: {deck_path}")
             cur_deck, _ = load_deck(deck_path)
             self.deck_df = pd.DataFrame(cur_deck)
+            self.deck_words = set(self.deck_df["vi"])
+            if warm_cache:
+                print("Warming the dictionary cache with the deck...")
+                for word in self.deck_words:
+                    self.get_wikt_entry(word)
 
-    def get_wikt_entry(self, word: str) -> dict:
-        found_entries = get_entries(self.wikt_df, word)
+    def _build_wikt_entry(self, word: str) -> tuple[str, str]:
+        found_entries = get_entry_records(self.wikt_index, word)
 
-        if not found_entries.empty:
+        if found_entries:
             # Assume we want to exclude entries that are already in the deck
-            json_str, short_str = json_dump_entries(found_entries, word=word)
-        else:
-            json_str, short_str = "", ""
+            return json_dump_entries(found_entries, word=word)
+        return "", ""
 
+    def get_wikt_entry(self, word: str) -> dict:
+        # The word is hidden case insensitively in the meanings, so the normalized word gives the same result
+        json_str, short_str = self._cached_wikt_entry(normalize_headword(word))
         return {"json": json_str, "short": short_str}
 
-    def process_audio(
-        self, audio_bytes: bytes, max_n_gram: int = 4
-    ) -> tuple[str, dict, list[str]]:
+    def cache_stats(self) -> dict:
+        """Returns the hits, misses, maximum and current size of the dictionary cache.
+
+        Warming the cache counts as misses.
+        """
+        return self._cached_wikt_entry.cache_info()._asdict()
+
+    def transcribe(self, audio_bytes: bytes | dict) -> str:
         # Assume the audio is in a correct format for ffmpeg to read
         # and has the correct sampling rate can handle it.
+        # Decoded audio can be passed as {"raw": samples, "sampling_rate": rate}.
         transcription: str = self.transcriber(audio_bytes)["text"]
-        transcription = re.sub(r"(^\W|\W$)", "", transcription.lower())
-        word_splits = transcription.split()
+        return re.sub(r"(^\W|\W$)", "", transcription.lower())
 
-        result_dict = {}
-        searched_words = []
+    def lookup(
+        self, transcription: str, max_n_gram: int = 4
+    ) -> tuple[dict, list[str]]:
+        """Looks up the dictionary words of a transcription and the words that are already in the deck."""
+        word_splits = transcription.split()
 
         if max_n_gram > 0:
-            for n in range(1, max_n_gram + 1):
-                for j in range(len(word_splits)):
-                    word = " ".join(word_splits[j : j + n])
-                    if word in result_dict:
-                        continue
-
-                    result = self.get_wikt_entry(word)
-                    result_dict[word] = result
-                    searched_words.append(word)
+            # Find all n-grams that are headwords in one pass, ordered like the n-grams
+            hits = self.headword_trie.find_all(
+                [normalize_headword(word) for word in word_splits], max_n_gram
+            )
+            found_words = [
+                " ".join(word_splits[j : j + n])
+                for j, n in sorted(hits, key=lambda hit: (hit[1], hit[0]))
+            ]
+            searched_words = ngrams(word_splits, max_n_gram)
         else:  # If max_n_gram is 0, search for the whole transcription
-            word = transcription
-            result = self.get_wikt_entry(word)
-            result_dict[word] = result
-            searched_words.append(word)
+            found_words = [transcription]
+            searched_words = [transcription]
 
+        # Only the words with entries are serialized
+        result_dict = {}
+        for word in found_words:
+            if word not in result_dict:
+                result_dict[word] = self.get_wikt_entry(word)
         result_dict = {k: v for k, v in result_dict.items() if v["json"]}
 
-        existing_words = pd.Series()
-        if self.deck_df is not None:
-            searched = pd.Series(searched_words)
-            existing_words: pd.Series = searched[searched.isin(self.deck_df["vi"])]
+        existing_words = [word for word in searched_words if word in self.deck_words]
+
+        return result_dict, existing_words
 
-        return transcription, result_dict, existing_words.to_list()
+    def process_audio(
+        self, audio_bytes: bytes, max_n_gram: int = 4
+    ) -> tuple[str, dict, list[str]]:
+        transcription = self.transcribe(audio_bytes)
+        result_dict, existing_words = self.lookup(transcription, max_n_gram)
+        return transcription, result_dict, existing_words
 
 
 if __name__ == "__main__":
@@ -98,6 +144,66 @@ if __name__ == "__main__":
         "--model_name", type=str, required=True, help="Name of the ASR model"
     )
     parser.add_argument("--deck", type=str, required=False, help="Name of the deck")
+    parser.add_argument(
+        "--wikt_cache_dir",
+        type=str,
+        required=False,
+        help="Folder for the compiled Wiktionary store. Defaults to .wikt_cache next to the JSONL file",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=4096,
+        help="Number of words to keep the serialized dictionary entries of",
+    )
+    parser.add_argument(
+        "--warm_cache",
+        action="store_true",
+        help="Fill the dictionary cache with the words of the deck at startup",
+    )
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        help="Serve with the production server waitress instead of the Flask development server",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on")
+    parser.add_argument(
+        "--max_pending",
+        type=int,
+        default=8,
+        help="Maximum number of audio requests in progress, more are rejected with 503",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=1,
+        help="Transcribe up to this many concurrent requests in one batch, 1 disables batching",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10,
+        help="Maximum time to wait for a batch to fill up",
+    )
+    parser.add_argument(
+        "--max_sessions",
+        type=int,
+        default=4,
+        help="Maximum number of concurrent streaming sessions",
+    )
+    parser.add_argument(
+        "--window_s",
+        type=float,
+        default=10.0,
+        help="Length of the audio windows of the streaming transcription in seconds, below 28",
+    )
+    parser.add_argument(
+        "--max_stream_mb",
+        type=float,
+        default=16,
+        help="Maximum size of the audio of a streaming session in MB",
+    )
 
     # Step 4: Parse the arguments
     args = parser.parse_args()
@@ -109,7 +215,28 @@ if __name__ == "__main__":
     # Step 5: Use the parsed arguments to initialize the TranscriptionProcessor
     app = Flask(__name__)
     processor = TranscriptionProcessor(
-        wikt_path=args.wikt_path, model_name=args.model_name, deck_path=args.deck
+        wikt_path=args.wikt_path,
+        model_name=args.model_name,
+        deck_path=args.deck,
+        wikt_cache_dir=args.wikt_cache_dir,
+        cache_size=args.cache_size,
+        warm_cache=args.warm_cache,
+    )
+    if args.max_batch_size > 1:
+        processor.transcriber = BatchingTranscriber(
+            processor.transcriber, args.max_batch_size, args.max_wait_ms
+        )
+    jobs = AudioJobQueue(
+        processor,
+        args.max_pending,
+        transcribe_workers=max(args.max_batch_size, 1),
+    )
+    streaming = StreamingTranscriber(
+        jobs,
+        processor.sampling_rate,
+        window_s=args.window_s,
+        max_sessions=args.max_sessions,
+        max_session_bytes=int(args.max_stream_mb * (1 << 20)),
     )
 
     @app.route("/process_audio", methods=["POST"])
@@ -129,9 +256,12 @@ if __name__ == "__main__":
             with open("most_recent.wav", "wb") as f:
                 f.write(audio_file)
 
-        transcription, result, existing_words = processor.process_audio(
-            audio_file, max_n_gram
-        )
+        try:
+            transcription, result, existing_words = jobs.process_audio(
+                audio_file, max_n_gram
+            )
+        except ServerBusy:
+            return "Server is busy, try again later", 503, {"Retry-After": "1"}
         print(f"Finished processing audio: {transcription}")
         return {
             "transcription": transcription,
@@ -139,6 +269,51 @@ if __name__ == "__main__":
             "existing_words": existing_words,
         }
 
+    @app.route("/stream/start", methods=["POST"])
+    def stream_start():
+        max_n_gram = int(request.form.get("max_n_gram", 4))
+        try:
+            session = streaming.start(max_n_gram)
+        except ServerBusy:
+            return "Server is busy, try again later", 503, {"Retry-After": "1"}
+        return {"session": session.id}
+
+    @app.route("/stream/<session_id>/chunk", methods=["POST"])
+    def stream_chunk(session_id):
+        session = streaming.get(session_id)
+        if session is None:
+            return "Session not found", 404
+        try:
+            session.add_chunk(request.get_data())
+        except SessionTooLarge as e:
+            return str(e), 413
+        return "", 204
+
+    @app.route("/stream/<session_id>/stop", methods=["POST"])
+    def stream_stop(session_id):
+        session = streaming.get(session_id)
+        if session is None:
+            return "Session not found", 404
+        session.stop()
+        return "", 204
+
+    @app.route("/stream/<session_id>/events", methods=["GET"])
+    def stream_events(session_id):
+        session = streaming.get(session_id)
+        if session is None:
+            return "Session not found", 404
+
+        # Server-sent events, each update is pushed as soon as it is ready
+        def generate():
+            for update in streaming.events(session):
+                yield f"data: {json.dumps(update, ensure_ascii=False)}\n\n"
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     @app.route("/")
     def serve_gui():
         return send_from_directory(
@@ -157,4 +332,26 @@ if __name__ == "__main__":
         else:
             return {"deck": 0}, 200, {"Content-Type": "application/json"}
 
-    app.run(debug=False)
+    @app.route("/cache_stats", methods=["GET"])
+    def cache_stats():
+        return processor.cache_stats(), 200, {"Content-Type": "application/json"}
+
+    @app.route("/batch_stats", methods=["GET"])
+    def batch_stats():
+        if isinstance(processor.transcriber, BatchingTranscriber):
+            stats = processor.transcriber.stats()
+        else:
+            stats = {"batches": 0, "requests": 0, "max_batch_size": 1}
+        return stats, 200, {"Content-Type": "application/json"}
+
+    if args.production:
+        # More threads than pending jobs and streams (events and chunk uploads),
+        # so busy requests are answered right away
+        serve(
+            app,
+            args.host,
+            args.port,
+            threads=args.max_pending + 2 * args.max_sessions + 4,
+        )
+    else:
+        app.run(debug=False, host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,200 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ServerBusy(Exception):
+    """Raised when the maximum number of audio jobs is already being processed."""
+
+
+class BatchingTranscriber:
+    """Collects concurrent transcription requests into batches for the `transformers` ASR pipeline.
+
+    It can be called like the pipeline with a single audio. The calls of all threads are queued, and a scheduler
+    thread passes up to `max_batch_size` of them to the pipeline at once, waiting at most `max_wait_ms` for a
+    batch to fill up. The model is only used from the scheduler thread.
+
+    Parameters
+    ----------
+    transcriber : Pipeline
+        The ASR pipeline.
+    max_batch_size : int
+        Maximum number of audios to transcribe at once.
+    max_wait_ms : float
+        Maximum time to wait for more requests after the first one of a batch arrived.
+    """
+
+    def __init__(self, transcriber, max_batch_size: int = 8, max_wait_ms: float = 10):
+        self.transcriber = transcriber
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_batches = 0
+        self.num_requests = 0
+        self._requests: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self._thread.start()
+
+    def __call__(self, audio_bytes: bytes) -> dict:
+        future: Future = Future()
+        self._requests.put((audio_bytes, future))
+        return future.result()
+
+    def _next_batch(self) -> list:
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = list(
+                    self.transcriber([audio for audio, _ in batch], batch_size=len(batch))
+                )
+                if len(outputs) != len(batch):
+                    raise RuntimeError(
+                        f"The transcriber returned {len(outputs)} outputs for {len(batch)} audios"
+                    )
+                self.num_batches += 1
+                self.num_requests += len(batch)
+                for (_, future), output in zip(batch, outputs):
+                    future.set_result(output)
+            except Exception as e:
+                # Fail all unresolved requests of the batch, so no request thread waits forever.
+                # The scheduler keeps running
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.num_batches,
+            "requests": self.num_requests,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+class AudioJobQueue:
+    """Runs the audio jobs of concurrent requests with bounded capacity.
+
+    The transcriptions run in a dedicated thread, as the model is not shared safely between threads and would
+    compete for the GPU (see `BatchingTranscriber` to transcribe several at once). The dictionary lookups of
+    finished transcriptions run in the request threads, so the next transcription starts while the previous
+    lookups are still running.
+
+    Parameters
+    ----------
+    processor : TranscriptionProcessor
+        The processor with the transcriber and the dictionary.
+    max_pending : int
+        Maximum number of jobs being processed or waiting. More jobs are rejected with `ServerBusy`
+        instead of piling up.
+    transcribe_workers : int
+        Number of threads calling the transcriber. Only use more than one with a `BatchingTranscriber`,
+        which needs concurrent calls to fill its batches.
+    """
+
+    def __init__(
+        self,
+        processor,
+        max_pending: int = 8,
+        transcribe_workers: int = 1,
+    ):
+        self.processor = processor
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._transcribe_executor = ThreadPoolExecutor(
+            transcribe_workers, thread_name_prefix="transcribe"
+        )
+
+    def process_audio(
+        self, audio_bytes: bytes, max_n_gram: int = 4
+    ) -> tuple[str, dict, list[str]]:
+        """Processes the audio like `TranscriptionProcessor.process_audio`, blocking until it is done.
+
+        Raises
+        ------
+        ServerBusy
+            If `max_pending` jobs are already being processed.
+        """
+        self._acquire(0)
+        try:
+            transcription = self._transcribe(audio_bytes)
+            result, existing_words = self.processor.lookup(transcription, max_n_gram)
+        finally:
+            self._slots.release()
+        return transcription, result, existing_words
+
+    def transcribe(self, audio, timeout: float = 0) -> str:
+        """Transcribes audio bytes or samples as a job, e.g. a window of a streamed recording.
+
+        Parameters
+        ----------
+        audio : bytes | dict
+            The audio, see `TranscriptionProcessor.transcribe`.
+        timeout : float
+            How long to wait for a free job, 0 to not wait.
+
+        Raises
+        ------
+        ServerBusy
+            If `max_pending` jobs are still being processed after the timeout.
+        """
+        self._acquire(timeout)
+        try:
+            return self._transcribe(audio)
+        finally:
+            self._slots.release()
+
+    def _acquire(self, timeout: float):
+        acquired = (
+            self._slots.acquire(timeout=timeout)
+            if timeout > 0
+            else self._slots.acquire(blocking=False)
+        )
+        if not acquired:
+            raise ServerBusy(f"{self.max_pending} audio jobs are already pending")
+
+    def _transcribe(self, audio) -> str:
+        return self._transcribe_executor.submit(
+            self.processor.transcribe, audio
+        ).result()
+
+    def shutdown(self):
+        self._transcribe_executor.shutdown()
+
+
+def serve(app, host: str, port: int, threads: int):
+    """Serves the app with the production WSGI server waitress, or Flask's threaded server if it is not installed.
+
+    Parameters
+    ----------
+    app : Flask
+        The app to serve.
+    host : str
+        The host to listen on.
+    port : int
+        The port to listen on.
+    threads : int
+        Number of request threads. This should be more than the `max_pending` of the job queue, so busy requests
+        are rejected right away instead of waiting for a thread.
+    """
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        print("waitress is not installed, falling back to the Flask threaded server")
+        app.run(debug=False, host=host, port=port, threaded=True)
+        return
+
+    print(f"Serving with waitress on http://{host}:{port} with {threads} threads")
+    waitress_serve(app, host=host, port=port, threads=threads)
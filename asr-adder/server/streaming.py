@@ -0,0 +1,379 @@
+import subprocess
+import threading
+import time
+import uuid
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+from serving import AudioJobQueue, ServerBusy
+
+SAMPLE_BYTES = 4  # float32 samples
+MAX_WINDOW_S = 28.0  # Whisper transcribes at most 30 s at once
+
+
+class SessionTooLarge(Exception):
+    """Raised when a chunk would make the audio of a streaming session larger than allowed."""
+
+
+class PcmBuffer:
+    """The decoded samples of a streaming session, appended by the decoder as they are decoded.
+
+    The samples before the committed part of the transcription can be dropped, so the buffer only holds the
+    audio that is still transcribed. Sample positions are counted from the start of the recording.
+    """
+
+    def __init__(self):
+        self._pcm = bytearray()
+        self._start = 0  # Position of the first sample in the buffer
+        self.finished = False
+        self._changed = threading.Condition()
+
+    @property
+    def num_samples(self) -> int:
+        """Number of samples decoded since the start of the recording."""
+        return self._start + len(self._pcm) // SAMPLE_BYTES
+
+    def append(self, pcm: bytes):
+        with self._changed:
+            self._pcm.extend(pcm)
+            self._changed.notify_all()
+
+    def finish(self):
+        """Marks that the decoder is done and no more samples will be appended."""
+        with self._changed:
+            self.finished = True
+            self._changed.notify_all()
+
+    def wait(self, seen_samples: int, timeout: float) -> bool:
+        """Waits until there are more than `seen_samples` samples or the decoder finished.
+
+        Returns True if the decoder finished.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.num_samples > seen_samples or self.finished, timeout
+            )
+            return self.finished
+
+    def samples(self, start: int, end: int) -> np.ndarray:
+        """Returns a copy of the samples from position `start` up to `end`."""
+        with self._changed:
+            begin = (start - self._start) * SAMPLE_BYTES
+            return np.frombuffer(
+                bytes(self._pcm[begin : (end - self._start) * SAMPLE_BYTES]),
+                dtype=np.float32,
+            )
+
+    def drop(self, end: int):
+        """Frees the samples before position `end`."""
+        with self._changed:
+            del self._pcm[: (end - self._start) * SAMPLE_BYTES]
+            self._start = end
+
+
+class FfmpegDecoder:
+    """Decodes an audio file that is fed in chunks with a single ffmpeg process, e.g. the webm of a `MediaRecorder`.
+
+    ffmpeg reads the chunks from its stdin as they are fed and a reader thread appends the decoded mono float32
+    samples to the buffer, so each chunk is only decoded once.
+
+    Parameters
+    ----------
+    sampling_rate : int
+        The sampling rate to decode to.
+    pcm : PcmBuffer
+        The buffer to append the samples to. It is finished when ffmpeg exits.
+    """
+
+    def __init__(self, sampling_rate: int, pcm: PcmBuffer):
+        self.pcm = pcm
+        self._process = subprocess.Popen(
+            self.command(sampling_rate),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self._reader = threading.Thread(target=self._read, name="decoder", daemon=True)
+        self._reader.start()
+
+    @staticmethod
+    def command(sampling_rate: int) -> list[str]:
+        # Start decoding right away instead of probing the first megabytes of the input
+        return (
+            "ffmpeg -hide_banner -loglevel error -fflags nobuffer -probesize 32 -analyzeduration 0 -i pipe:0 "
+            f"-ac 1 -ar {sampling_rate} -f f32le -flush_packets 1 pipe:1"
+        ).split()
+
+    def _read(self):
+        try:
+            while True:
+                data = self._process.stdout.read1(1 << 16)
+                if not data:
+                    break
+                self.pcm.append(data)
+        finally:
+            self._process.wait()
+            self.pcm.finish()
+
+    def feed(self, chunk: bytes):
+        try:
+            self._process.stdin.write(chunk)
+            self._process.stdin.flush()
+        except OSError:  # ffmpeg exited, e.g. on invalid audio, the buffer is finished by the reader
+            pass
+
+    def close(self):
+        """Ends the input, ffmpeg decodes the rest and exits."""
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+
+    def kill(self):
+        self._process.kill()
+
+
+def quietest_cut(samples: np.ndarray, sampling_rate: int, start: int, frame_s: float = 0.03) -> int:
+    """Returns the middle of the quietest frame after position `start`, to cut the audio between words."""
+    frame = max(int(frame_s * sampling_rate), 1)
+    num_frames = (len(samples) - start) // frame
+    if num_frames < 1:
+        return len(samples)
+    frames = samples[start : start + num_frames * frame].reshape(num_frames, frame)
+    energy = np.square(frames, dtype=np.float64).mean(axis=1)
+    return start + int(np.argmin(energy)) * frame + frame // 2
+
+
+class StreamingSession:
+    """A recording that is uploaded in chunks while it is being recorded.
+
+    The chunks are the parts of one audio file, e.g. from a `MediaRecorder`, so they are decoded in order by a
+    single decoder into the PCM buffer of the session.
+
+    Parameters
+    ----------
+    session_id : str
+        The id of the session.
+    max_n_gram : int
+        The maximum n-gram length of the lookups.
+    decoder : Callable[[PcmBuffer], FfmpegDecoder]
+        Starts the decoder of the session for its buffer.
+    max_bytes : int
+        Maximum size of the uploaded audio.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        max_n_gram: int,
+        decoder: Callable[[PcmBuffer], FfmpegDecoder],
+        max_bytes: int,
+    ):
+        self.id = session_id
+        self.max_n_gram = max_n_gram
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.stopped = False
+        self.last_active = time.monotonic()
+        self.pcm = PcmBuffer()
+        self._decoder = decoder(self.pcm)
+        self._lock = threading.Lock()
+
+    def add_chunk(self, chunk: bytes):
+        """Feeds the next chunk of the audio to the decoder.
+
+        Raises
+        ------
+        SessionTooLarge
+            If the audio would get larger than `max_bytes`. The session is stopped, so its last update is sent.
+        """
+        with self._lock:
+            if self.stopped:
+                return
+            if self.num_bytes + len(chunk) > self.max_bytes:
+                self._stop()
+                raise SessionTooLarge(f"Streamed audio is limited to {self.max_bytes} bytes")
+            self.num_bytes += len(chunk)
+            self.last_active = time.monotonic()
+            self._decoder.feed(chunk)
+
+    def _stop(self):
+        self.stopped = True
+        self.last_active = time.monotonic()
+        self._decoder.close()
+
+    def stop(self):
+        """Ends the recording, the decoder finishes the buffer once the rest of the audio is decoded."""
+        with self._lock:
+            if not self.stopped:
+                self._stop()
+
+    def close(self):
+        """Releases the decoder, also if it is still running."""
+        with self._lock:
+            self.stopped = True
+            self._decoder.kill()
+
+
+class StreamingTranscriber:
+    """Transcribes recordings while they are uploaded and pushes the dictionary words as soon as they are found.
+
+    Each update transcribes the audio since the last committed window, so the latest words are available right
+    away. Once that part is longer than `window_s`, it is cut at the quietest moment of the second half of its
+    first `window_s`, so the cut falls between words. The transcription up to the cut is committed and its
+    samples are dropped, so each update only transcribes a short window even for long recordings. Commits are
+    skipped while the job queue is full, until the window reaches twice `window_s` (at most `MAX_WINDOW_S`),
+    then they wait for a free job so the window stays short enough for the model.
+
+    Parameters
+    ----------
+    jobs : AudioJobQueue
+        The job queue, the transcriptions count towards its `max_pending` jobs like the other requests.
+    sampling_rate : int
+        The sampling rate of the transcriber.
+    window_s : float
+        Length of the audio after which a window is committed, below `MAX_WINDOW_S`.
+    max_sessions : int
+        Maximum number of concurrent sessions, more are rejected with `ServerBusy`.
+    max_session_bytes : int
+        Maximum size of the uploaded audio of a session, see `StreamingSession.add_chunk`.
+    idle_timeout_s : float
+        Sessions without new audio for this long are closed. This is also how long the final transcription
+        waits for a free job.
+    decoder : Callable[[int, PcmBuffer], FfmpegDecoder], optional
+        Starts the decoder of a session for the sampling rate and its buffer, defaults to `FfmpegDecoder`.
+    """
+
+    def __init__(
+        self,
+        jobs: AudioJobQueue,
+        sampling_rate: int,
+        window_s: float = 10.0,
+        max_sessions: int = 4,
+        max_session_bytes: int = 16 << 20,
+        idle_timeout_s: float = 60.0,
+        decoder: Callable[[int, PcmBuffer], FfmpegDecoder] = FfmpegDecoder,
+    ):
+        self.jobs = jobs
+        self.sampling_rate = sampling_rate
+        self.window_samples = int(window_s * sampling_rate)
+        self.max_window_samples = max(
+            self.window_samples, min(2 * self.window_samples, int(MAX_WINDOW_S * sampling_rate))
+        )
+        self.max_sessions = max_sessions
+        self.max_session_bytes = max_session_bytes
+        self.idle_timeout_s = idle_timeout_s
+        self.decoder = decoder
+        self._sessions: dict[str, StreamingSession] = {}
+        self._lock = threading.Lock()
+
+    def start(self, max_n_gram: int = 4) -> StreamingSession:
+        """Starts a new session.
+
+        Raises
+        ------
+        ServerBusy
+            If `max_sessions` sessions are already active.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for session_id, session in list(self._sessions.items()):
+                if now - session.last_active > self.idle_timeout_s:
+                    session.close()
+                    del self._sessions[session_id]
+            if len(self._sessions) >= self.max_sessions:
+                raise ServerBusy(f"{self.max_sessions} streaming sessions are already active")
+
+            session = StreamingSession(
+                uuid.uuid4().hex,
+                max_n_gram,
+                lambda pcm: self.decoder(self.sampling_rate, pcm),
+                self.max_session_bytes,
+            )
+            self._sessions[session.id] = session
+            return session
+
+    def get(self, session_id: str) -> Optional[StreamingSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def _transcribe(self, samples: np.ndarray, wait: bool) -> Optional[str]:
+        """Transcribes through the job queue, returns None if it is busy."""
+        try:
+            return self.jobs.transcribe(
+                {"raw": samples, "sampling_rate": self.sampling_rate},
+                timeout=self.idle_timeout_s if wait else 0,
+            )
+        except ServerBusy:
+            return None
+
+    def events(self, session: StreamingSession) -> Iterator[dict]:
+        """Yields an update when new audio was decoded, until the recording is stopped, the last one is final.
+
+        Each update has the transcription so far and only the dictionary words and deck words that were not in
+        a previous update of the session, in the format of `/process_audio`. Updates are skipped while the job
+        queue is full.
+        """
+        committed_text: list[str] = []
+        window_start = 0  # Start of the audio that is not committed yet
+        transcribed = 0  # Number of samples of the last update
+        text = ""  # Transcription of the window of the last update
+        sent_words: set[str] = set()
+        sent_existing: set[str] = set()
+
+        try:
+            while True:
+                finished = session.pcm.wait(transcribed, self.idle_timeout_s)
+                num_samples = session.pcm.num_samples
+                if num_samples == transcribed and not finished:  # Idle timeout
+                    break
+                transcribed = num_samples
+                window = session.pcm.samples(window_start, num_samples)
+
+                while len(window) >= self.window_samples:
+                    # Past the cap the window gets too long for the model, so the commit waits for a free job
+                    too_long = len(window) >= self.max_window_samples
+                    if finished and not too_long:
+                        break
+                    cut = quietest_cut(
+                        window[: self.window_samples], self.sampling_rate, self.window_samples // 2
+                    )
+                    committed = self._transcribe(window[:cut], wait=too_long)
+                    if committed is None:
+                        break
+                    committed_text.append(committed)
+                    window_start += cut
+                    session.pcm.drop(window_start)
+                    window = window[cut:]
+                    text = ""
+
+                if len(window):
+                    # The final transcription waits for a free job, else the last partial one is kept
+                    new_text = self._transcribe(window, wait=finished)
+                    if new_text is None and not finished:
+                        continue
+                    text = new_text if new_text is not None else text
+                else:
+                    text = ""
+                transcription = " ".join(committed_text + [text]).strip()
+
+                result, existing_words = self.jobs.processor.lookup(
+                    transcription, session.max_n_gram
+                )
+                new_result = {w: v for w, v in result.items() if w not in sent_words}
+                new_existing = [w for w in existing_words if w not in sent_existing]
+                sent_words.update(new_result)
+                sent_existing.update(new_existing)
+
+                yield {
+                    "transcription": transcription,
+                    "result": new_result,
+                    "existing_words": new_existing,
+                    "final": finished,
+                }
+                if finished:
+                    break
+        finally:
+            session.close()
+            with self._lock:
+                self._sessions.pop(session.id, None)
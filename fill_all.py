@@ -0,0 +1,201 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from anki_utils.deck import load_deck, write_deck
+from anki_examples.fill_examples import DEFAULT_MODEL, fill_deck_examples
+from anki_examples.find_examples import CorpusExamples
+from wiktionary_defs.fill_with_wikt import fill_deck
+from wiktionary_defs.fingerprints import fingerprints_path_for
+
+# The fields each stage changes, so the stages can fill separate copies of the deck
+DEFINITION_FIELDS = ["en", "wiktdata"]
+EXAMPLE_FIELDS = ["examples"]
+
+
+def fill_definitions(deck, args):
+    start = time.time()
+    fingerprints = fill_deck(
+        deck,
+        args.wikt_extract,
+        args.filters,
+        args.refill,
+        cache_dir=args.cache_dir,
+        use_cache=not args.no_cache,
+        stream=args.stream,
+        lang_code=args.lang_code,
+        workers=args.workers,
+        incremental=args.incremental,
+        fingerprints_path=args.fingerprints or fingerprints_path_for(args.out),
+    )
+    print(f"Definitions filled in {time.time() - start:.1f}s")
+    return fingerprints
+
+
+def fill_examples(deck, args):
+    start = time.time()
+    corpus = CorpusExamples(args.corpus, backend=args.backend)
+    fill_deck_examples(
+        deck,
+        corpus,
+        args.num_examples,
+        embeddings=args.embeddings,
+        model=args.model,
+        nprobe=args.nprobe,
+    )
+    print(f"Examples filled in {time.time() - start:.1f}s")
+
+
+def run_stage(stage, deck, args, fields):
+    """Runs a stage on the deck and returns the fields it filled for each note, together with its result."""
+    result = stage(deck, args)
+    return [{field: note_dict[field] for field in fields} for note_dict in deck], result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fills the Anki deck with Wiktionary definitions and example sentences, writing it once."
+    )
+    parser.add_argument(
+        "--deck", type=str, help="Path to the Anki deck CSV file", required=True
+    )
+    parser.add_argument(
+        "--out", type=str, help="Path to the output CSV file", required=True
+    )
+    parser.add_argument(
+        "--wikt_extract",
+        type=str,
+        help="Path to the wiktextract JSONL file",
+        required=True,
+    )
+    parser.add_argument(
+        "--corpus", type=str, help="Corpus folder or corpus store", required=True
+    )
+    parser.add_argument(
+        "--refill",
+        action="store_true",
+        help="Refill the deck even if it has Wiktionary data already",
+    )
+    parser.add_argument(
+        "--filters",
+        type=str,
+        default="Sino-Vietnamese Reading of;(obsolete)",
+        help="Semicolon (;) separated list of filters",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Folder for the compiled Wiktionary store. Defaults to .wikt_cache next to the JSONL file",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Parse the JSONL file without reading or writing the compiled Wiktionary store",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the JSONL file and only keep the entries of the words in the deck (low memory)",
+    )
+    parser.add_argument(
+        "--lang_code",
+        type=str,
+        default=None,
+        help="Only keep entries of this language code when streaming, e.g. vi for multilingual dumps",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to look up the Wiktionary entries with",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only refill the notes whose Wiktionary entries or filters changed since the last incremental run",
+    )
+    parser.add_argument(
+        "--fingerprints",
+        type=str,
+        default=None,
+        help="Sidecar file with the note fingerprints for --incremental. Defaults to <out>.wikt_fingerprints.json",
+    )
+    parser.add_argument(
+        "--num_examples",
+        type=int,
+        default=20,
+        help="Number of examples to fill each line",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="auto",
+        choices=["auto", "scan", "index"],
+        help="Search backend: scan (GPU with cudf), index (CPU) or auto",
+    )
+    parser.add_argument(
+        "--embeddings",
+        type=str,
+        default=None,
+        help="Embedding store of the corpus, to pick the examples closest in meaning to the definitions",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=DEFAULT_MODEL,
+        help="Sentence embedding model of the embedding store",
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=None,
+        help="Number of clusters of the ANN index to search with --embeddings, defaults to 5%% of the clusters, at least 8",
+    )
+    parser.add_argument(
+        "--concurrent",
+        action="store_true",
+        help="Run the definition and example stages at the same time in separate processes. Ignored with "
+        "--embeddings, as the examples are then ranked by the filled definitions",
+    )
+    args = parser.parse_args()
+    for path in [args.deck, args.wikt_extract, args.corpus]:
+        assert os.path.exists(path), f"Path {path} does not exist."
+
+    start = time.time()
+    # Backup the original deck first
+    shutil.copy(args.deck, args.deck + ".bak")
+    deck, metadata = load_deck(args.deck)
+
+    # The stages change different fields of the notes, so they can run at the same time, unless the examples
+    # are picked by the definitions. Each stage runs in its own spawned process, as both start process pools,
+    # which must not be forked from a process with several threads
+    if args.concurrent and not args.embeddings:
+        with ProcessPoolExecutor(
+            2, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            definitions = executor.submit(
+                run_stage, fill_definitions, deck, args, DEFINITION_FIELDS
+            )
+            examples = executor.submit(
+                run_stage, fill_examples, deck, args, EXAMPLE_FIELDS
+            )
+            definition_fields, fingerprints = definitions.result()
+            example_fields, _ = examples.result()
+        for note_dict, filled_definitions, filled_examples in zip(
+            deck, definition_fields, example_fields
+        ):
+            note_dict.update(filled_definitions)
+            note_dict.update(filled_examples)
+    else:
+        fingerprints = fill_definitions(deck, args)
+        fill_examples(deck, args)
+
+    write_deck(deck, metadata, args.out)
+    # Only after the deck was written, so the notes are not marked as filled if a stage or writing failed
+    if fingerprints is not None:
+        fingerprints.save()
+    print(f"All Done in {time.time() - start:.1f}s!")
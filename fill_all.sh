@@ -46,10 +46,7 @@ echo "Output: $OUT"
 echo "Wiktionary Extract: $WIKT_EXTRACT"
 echo "Corpus: $CORPUS"
 
-echo "FILLING WITH WIKTIONARY DEFINITIONS..."
-python3 wiktionary_defs/fill_with_wikt.py --deck $DECK --out $OUT --wikt_extract $WIKT_EXTRACT $REFILL
-
-echo "FILLING WITH EXAMPLE SENTENCES..."
-python3 anki_examples/fill_examples.py --deck $OUT --out $OUT --corpus $CORPUS
+echo "FILLING WITH WIKTIONARY DEFINITIONS AND EXAMPLE SENTENCES..."
+python3 fill_all.py --deck $DECK --out $OUT --wikt_extract $WIKT_EXTRACT --corpus $CORPUS $REFILL
 
 echo "All Done!"
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from anki_examples.ann_index import IVFIndex
+
+
+def clustered_embeddings(num_clusters=50, per_cluster=400, dim=32, noise=0.05, seed=0):
+    """Returns normalized embeddings around well separated centers, and the center of each embedding."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    labels = np.repeat(np.arange(num_clusters), per_cluster)
+    embeddings = centers[labels] + noise * rng.standard_normal((len(labels), dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings, centers, labels
+
+
+def test_default_size():
+    embeddings, _, _ = clustered_embeddings()
+    index = IVFIndex(embeddings)
+    assert len(index) == int(np.sqrt(len(embeddings)))
+    assert index.list_offsets[-1] == len(embeddings)
+    assert np.array_equal(np.sort(index.list_ids), np.arange(len(embeddings)))
+
+
+def test_probe_narrows_to_query_cluster():
+    embeddings, centers, labels = clustered_embeddings()
+    index = IVFIndex(embeddings)
+    ids = index.probe(centers[7])
+    assert len(ids) < len(embeddings) // 4
+    assert np.isin(np.flatnonzero(labels == 7), ids).all()
+
+    ids, scores = index.search(centers[7], 10)
+    assert (labels[ids] == 7).all()
+    assert np.all(np.diff(scores) <= 0)
+
+
+class FakeBackend:
+    def __init__(self, candidates):
+        self.candidates = candidates
+
+    def find(self, ex):
+        return self.candidates
+
+
+class FakeCorpus:
+    def __init__(self, size):
+        self.texts = [f"sentence {i}" for i in range(size)]
+
+    def records(self, positions):
+        return [{"id": i, "text": self.texts[i]} for i in positions]
+
+
+class FakeRanker:
+    def __init__(self, embeddings, queries):
+        self.embeddings = embeddings
+        self.queries = queries
+        self.ranked_ids = []
+
+    def encode_numpy(self, texts):
+        return self.queries
+
+    def embed_sentences(self, ids, texts, store):
+        self.ranked_ids.append(np.asarray(ids))
+        return self.embeddings[ids]
+
+
+class FakeStore:
+    def missing(self, ids):
+        return np.empty(0, dtype=np.int64)
+
+
+def test_find_examples_by_meaning_ranks_probed_candidates():
+    pytest.importorskip("sentence_transformers")  # Needed by format_example
+    from anki_examples.find_examples import CorpusExamples
+
+    embeddings, centers, labels = clustered_embeddings()
+    index = IVFIndex(embeddings)
+    candidates = np.arange(0, len(embeddings), 2)  # Every other sentence contains the word
+
+    corpus = CorpusExamples.__new__(CorpusExamples)
+    corpus.corpus = FakeCorpus(len(embeddings))
+    corpus.backend = FakeBackend(candidates)
+
+    def find(ann_index):
+        ranker = FakeRanker(embeddings, centers[[7]])
+        found = corpus.find_examples_by_meaning(
+            ["word"], ["gloss"], 10, ranker, FakeStore(), ann_index=ann_index, ann_min_candidates=100
+        )
+        return [e["id"] for e in found["word"]], ranker.ranked_ids[0]
+
+    ann_found, ann_ranked = find(index)
+    brute_found, brute_ranked = find(None)
+
+    assert len(brute_ranked) == len(candidates)
+    assert len(ann_ranked) < len(candidates) // 4
+    assert np.isin(ann_ranked, candidates).all()
+    assert (labels[ann_ranked] == 7).mean() > 0.1
+    assert ann_found == brute_found
@@ -0,0 +1,109 @@
+import argparse
+import json
+import random
+import time
+
+from anki_utils.deck import load_deck
+from wiktionary_defs.fill_with_wikt import (
+    get_entries,
+    get_entry_records,
+    json_dump_entries,
+    process_senses,
+)
+from wiktionary_defs.wikt_store import load_wiktionary_index
+
+FILTER_WORDS = ["Sino-Vietnamese Reading of", "(obsolete)"]
+
+
+def json_dump_entries_iterrows(entries, word, filter_words):
+    """The previous DataFrame based implementation of `json_dump_entries`, as the baseline."""
+    out_entries = []
+    entries_short_str = []
+    for _, row in entries.iterrows():
+        cur_entry = {}
+        cur_entry["pos"] = row["pos"]
+
+        if "synonyms" in row and isinstance(row["synonyms"], list) and row["synonyms"]:
+            cur_entry["synonyms"] = [syn["word"] for syn in row["synonyms"]]
+
+        if "etymology_text" in row and row["etymology_text"]:
+            cur_entry["etymology"] = row["etymology_text"]
+
+        cur_entry["meanings"], senses_string = process_senses(
+            row["senses"], word=word, filter_words=filter_words
+        )
+        if not cur_entry["meanings"]:
+            continue
+
+        out_entries.append(cur_entry)
+        entries_short_str.append(f"{row['pos']}: {senses_string}")
+
+    return json.dumps(out_entries, ensure_ascii=False), " | ".join(entries_short_str)
+
+
+def dataframe_path(wikt_index, word):
+    entries = get_entries(wikt_index, word)
+    if not entries.empty:
+        json_dump_entries_iterrows(entries, word, FILTER_WORDS)
+
+
+def record_path(wikt_index, word):
+    entries = get_entry_records(wikt_index, word)
+    if entries:
+        json_dump_entries(entries, word, FILTER_WORDS)
+
+
+def benchmark(fn, wikt_index, words, repeat=3):
+    """Returns the best average time per word in seconds over `repeat` runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for word in words:
+            fn(wikt_index, word)
+        best = min(best, (time.perf_counter() - start) / len(words))
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks looking up and serializing Wiktionary entries per note."
+    )
+    parser.add_argument(
+        "--wikt_extract",
+        type=str,
+        help="Path to the wiktextract JSONL file",
+        required=True,
+    )
+    parser.add_argument(
+        "--deck", type=str, help="Take the words from this deck instead of sampling"
+    )
+    parser.add_argument(
+        "--num_words", type=int, default=2000, help="Number of words to benchmark"
+    )
+    args = parser.parse_args()
+
+    wikt_index = load_wiktionary_index(args.wikt_extract)
+    if args.deck:
+        deck, _ = load_deck(args.deck)
+        words = [note_dict["vi"] for note_dict in deck][: args.num_words]
+    else:
+        headwords = list(wikt_index.headwords())
+        words = random.sample(headwords, min(args.num_words, len(headwords)))
+
+    # The deck fields must not change, so check both paths give the same output
+    for word in words:
+        entries = get_entries(wikt_index, word)
+        if not entries.empty:
+            assert json_dump_entries_iterrows(
+                entries, word, FILTER_WORDS
+            ) == json_dump_entries(get_entry_records(wikt_index, word), word, FILTER_WORDS), word
+
+    # Decode the records once, so both paths are measured with warm pages
+    benchmark(record_path, wikt_index, words, repeat=1)
+
+    dataframe_time = benchmark(dataframe_path, wikt_index, words)
+    record_time = benchmark(record_path, wikt_index, words)
+    print(f"Words: {len(words)}")
+    print(f"DataFrame + iterrows: {dataframe_time * 1e6:8.1f} µs/note")
+    print(f"Dict records        : {record_time * 1e6:8.1f} µs/note")
+    print(f"Speedup             : {dataframe_time / record_time:8.1f}x")
@@ -1,14 +1,28 @@
 import argparse
 import json
+import multiprocessing
 import os
 import re
 import shutil
 import sys
-from typing import List
+from functools import lru_cache
+from typing import List, Optional, Union
 
 import pandas as pd
 from tqdm import tqdm
 from anki_utils.deck import load_deck, write_deck
+from wiktionary_defs.wikt_index import WiktionaryIndex
+from wiktionary_defs.fingerprints import (
+    NoteFingerprints,
+    fingerprints_path_for,
+    note_fingerprint,
+    note_key,
+)
+from wiktionary_defs.wikt_store import (
+    load_wiktextract_subset,
+    load_wiktionary_index,
+    source_fingerprint,
+)
 
 
 def load_wiktextract(file_path: str) -> pd.DataFrame:
@@ -37,16 +51,16 @@ def load_wiktextract(file_path: str) -> pd.DataFrame:
     return df.fillna("")
 
 
-def get_entries(wikt_df: pd.DataFrame, word: str) -> pd.DataFrame:
+def get_entries(wikt_index: WiktionaryIndex, word: str) -> pd.DataFrame:
     """
-    Retrieve entries from a DataFrame that match a given word.
+    Retrieve entries from the Wiktionary index that match a given word.
 
     Parameters
     ----------
-    wikt_df : pd.DataFrame
-        The DataFrame containing Wiktionary entries.
+    wikt_index : WiktionaryIndex
+        The index over the Wiktionary entries, see `load_wiktionary_index`.
     word : str
-        The word to search for in the DataFrame.
+        The word to search for in the index.
 
     Returns
     -------
@@ -54,47 +68,45 @@ def get_entries(wikt_df: pd.DataFrame, word: str) -> pd.DataFrame:
         A DataFrame containing entries where the 'word' column matches the given word (case insensitive).
     """
 
-    def handle_alternative_spelling(results: pd.DataFrame) -> pd.DataFrame:
-        # If for all sense in the results, we match "Alternative spelling of", we need to check again with the alternative spelling
-        alternative_spelling_regex = re.compile(r"Alternative spelling of (.+)")
+    # If all senses are "Alternative spelling of", the entries of the alternative spelling are returned
+    return wikt_index.lookup(wikt_index.resolve(word))
+
+
+def get_entry_records(wikt_index: WiktionaryIndex, word: str) -> List[dict]:
+    """Same as `get_entries`, but returns the entries as plain dicts without building a DataFrame.
+
+    Returns
+    -------
+    List[dict]
+        The entries of the given word (case insensitive), empty if the word was not found.
+    """
+    return wikt_index.entries(wikt_index.resolve(word))
 
-        def all_senses_alternative_spelling(results):
-            return all(
-                "Alternative spelling of" in gloss
-                for row in results.itertuples()
-                for sense in row.senses
-                for gloss in sense["glosses"]
-            )
 
-        if all_senses_alternative_spelling(results):
-            first_gloss = results.iloc[0]["senses"][0]["glosses"][0]
-            match = alternative_spelling_regex.search(first_gloss)
-            if match:
-                alternative_spelling: str = match.group(1)
-
-                # Case: Explanation in Brackets
-                # Ex: Alternative spelling of tổng thư kí (“Secretary General”)
-                bracket_i = alternative_spelling.find(" (")
-                if bracket_i != -1:
-                    alternative_spelling = alternative_spelling[
-                        : alternative_spelling.find(" (")
-                    ]
-                # Case: Only provided alternative spelling
-                if alternative_spelling.endswith("."):
-                    alternative_spelling = alternative_spelling[:-1]
-
-                results = wikt_df[
-                    wikt_df["word"].str.lower() == alternative_spelling.lower()
-                ]
-            else:
-                print(f"WARN: Tried but not find alternative spelling in {first_gloss}")
-
-        return results
-
-    results = wikt_df[wikt_df["word"].str.lower() == word.lower()]
-    if not results.empty:
-        results = handle_alternative_spelling(results)
-    return results
+def dump_json(obj) -> str:
+    """Serializes to the JSON string stored in the wiktdata field.
+
+    The format must stay the same, so refilling a deck does not change the notes whose entries did not change.
+    """
+    return json.dumps(obj, ensure_ascii=False)
+
+
+@lru_cache(maxsize=4096)
+def _word_masker(word: str) -> re.Pattern:
+    """Compiles the pattern that hides the word in a meaning, once per word."""
+    return re.compile(re.escape(word), flags=re.IGNORECASE)
+
+
+@lru_cache(maxsize=64)
+def _filter_matcher(filter_words: tuple[str, ...]) -> Optional[re.Pattern]:
+    """Compiles all filter words into a single pattern that is matched against lower case meanings."""
+    filter_words = tuple(f_word.lower() for f_word in filter_words if f_word)
+    if not filter_words:
+        return None
+    # Longest first, so the alternation prefers the most specific filter
+    return re.compile(
+        "|".join(re.escape(f_word) for f_word in sorted(filter_words, key=len, reverse=True))
+    )
 
 
 def process_senses(
@@ -102,17 +114,28 @@ def process_senses(
 ) -> tuple[List[dict], str]:
     """Processes Wiktionary senses and extracts meanings and examples.
 
+    The word is hidden in the meanings and meanings containing any of the filter words are skipped.
+    Senses with the same meaning are merged.
+
     Parameters
     ----------
     senses : List[dict]
         The senses extracted from Wiktionary
+    word : str
+        The word that was searched for
+    filter_words : List[str], optional
+        Words to filter out from the meanings (case insensitive)
 
     Returns
     -------
     tuple[List[dict], str]
         A list of processed senses and a string representation of the meanings
     """
-    senses_processed = []
+    word_masker = _word_masker(word) if word else None
+    filter_matcher = _filter_matcher(tuple(filter_words))
+
+    # Meaning -> processed sense, dicts keep the insertion order
+    senses_processed: dict[str, dict] = {}
 
     for sense in senses:
         if "glosses" not in sense and "raw_glosses" not in sense:
@@ -123,41 +146,29 @@ def process_senses(
             if "raw_glosses" in sense
             else sense["glosses"][0]  # Always take the first, main meaning
         )
-        meaning = re.sub(
-            word, "___", meaning, flags=re.IGNORECASE
-        )  # So that when guessing, the word is not given away
+        if word_masker is not None:
+            # So that when guessing, the word is not given away
+            meaning = word_masker.sub("___", meaning)
 
-        if filter_words and any(
-            f_word.lower() in meaning.lower() for f_word in filter_words
-        ):
+        if filter_matcher is not None and filter_matcher.search(meaning.lower()):
             continue
 
-        # Check if the meaning is already in the list
-        sense_dict = next(
-            (s for s in senses_processed if s["meaning"] == meaning),
-            {"meaning": meaning},
-        )
-        # if the only key was "meaning"
-        created_new = len(sense_dict) == 1
+        sense_dict = senses_processed.setdefault(meaning, {"meaning": meaning})
 
         if "examples" in sense:
-            examples = sense_dict.get("examples", [])
+            examples = sense_dict.setdefault("examples", [])
             for ex in sense["examples"]:
                 if "english" not in ex:
                     examples.append(ex["text"])
                 else:
                     examples.append(ex["text"] + " ― " + ex["english"])
-            sense_dict["examples"] = examples
-        if created_new:  # Only append if a new sense dict was created
-            senses_processed.append(sense_dict)
 
-    meanings_formatted = [sense["meaning"] for sense in senses_processed]
-    senses_str = "; ".join(meanings_formatted)
-    return senses_processed, senses_str
+    senses_str = "; ".join(senses_processed)
+    return list(senses_processed.values()), senses_str
 
 
 def json_dump_entries(
-    entries: pd.DataFrame,
+    entries: Union[List[dict], pd.DataFrame],
     word: str,
     filter_words: List[str] = [
         "Sino-Vietnamese Reading of",
@@ -169,8 +180,8 @@ def json_dump_entries(
 
     Parameters
     ----------
-    entries : pd.DataFrame
-        Entries that were extracted from Wiktionary
+    entries : List[dict] or pd.DataFrame
+        Entries that were extracted from Wiktionary, preferably as dicts from `get_entry_records`
     word : str
         The word that was searched for
     filter_words : List[str], optional
@@ -181,86 +192,184 @@ def json_dump_entries(
     tuple[str, str]
         Converted JSON string and a short string representation
     """
+    if isinstance(entries, pd.DataFrame):
+        entries = entries.to_dict(orient="records")
+
     out_entries = []
     entries_short_str = []
-    for _, row in entries.iterrows():
-        cur_entry = {}
-        cur_entry["pos"] = row["pos"]
+    for entry in entries:
+        pos = entry.get("pos", "")
+        cur_entry = {"pos": pos}
 
-        if "synonyms" in row and row["synonyms"]:  # Synonyms can be NaN
-            cur_entry["synonyms"] = [syn["word"] for syn in row["synonyms"]]
+        synonyms = entry.get("synonyms")
+        if isinstance(synonyms, list) and synonyms:  # Synonyms can be NaN in DataFrames
+            cur_entry["synonyms"] = [syn["word"] for syn in synonyms]
 
-        if "etymology_text" in row and row["etymology_text"]:
-            cur_entry["etymology"] = row["etymology_text"]
+        if entry.get("etymology_text"):
+            cur_entry["etymology"] = entry["etymology_text"]
 
         cur_entry["meanings"], senses_string = process_senses(
-            row["senses"], word=word, filter_words=filter_words
+            entry.get("senses", []), word=word, filter_words=filter_words
         )
         if not cur_entry["meanings"]:
             continue
 
         out_entries.append(cur_entry)
 
-        entries_short_str.append(f"{row['pos']}: {senses_string}")
+        entries_short_str.append(f"{pos}: {senses_string}")
 
     short_meanings = " | ".join(entries_short_str)
 
-    json_string = json.dumps(out_entries, ensure_ascii=False)
+    json_string = dump_json(out_entries)
     return json_string, short_meanings
 
 
-def extract_and_fill(
+def lookup_note(
+    wikt_index: WiktionaryIndex, word: str, filter_words: List[str]
+) -> Optional[tuple[str, str]]:
+    """Looks up a word and converts its entries, see `json_dump_entries`.
+
+    Returns
+    -------
+    Optional[tuple[str, str]]
+        Converted JSON string and a short string representation, or None if the word was not found
+    """
+    found_entries = get_entry_records(wikt_index, word)
+    if not found_entries:
+        return None
+    return json_dump_entries(found_entries, word=word, filter_words=filter_words)
+
+
+# State of the worker processes, set once by the pool initializer
+_worker_state = {}
+
+
+def _init_worker(wikt_index: WiktionaryIndex, filter_words: List[str]):
+    _worker_state["wikt_index"] = wikt_index
+    _worker_state["filter_words"] = filter_words
+
+
+def _lookup_note_worker(word: str) -> Optional[tuple[str, str]]:
+    return lookup_note(_worker_state["wikt_index"], word, _worker_state["filter_words"])
+
+
+def _pool_context():
+    # Forked workers share the loaded index with the parent instead of receiving a pickled copy
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def fill_deck(
+    deck: List[dict],
     wikt_extract: str,
-    deck_csv_path: str,
     filters: str = "Sino-Vietnamese Reading of",
     refill: bool = False,
-):
-    """Extracts and fills the Anki deck with Wiktionary data.
+    cache_dir: Optional[str] = None,
+    use_cache: bool = True,
+    stream: bool = False,
+    lang_code: Optional[str] = None,
+    workers: int = 1,
+    incremental: bool = False,
+    fingerprints_path: str = "wikt_fingerprints.json",
+) -> Optional[NoteFingerprints]:
+    """Fills the notes of a loaded deck with Wiktionary data, in place.
+
+    Only the fields en and wiktdata of the notes are changed. See `extract_and_fill` for the parameters.
 
-    Parameters
-    ----------
-    wikt_extract : str
-        Path to the wiktextract JSONL file
-    deck_csv_path : str
-        Path to the Anki deck CSV file, which uses tab as a separator by default. The deck should be exported with identifiers.
-    filters : str, optional
-        Filters to apply to the meanings
-    refill : bool, optional
-        Refill the deck even if it has Wiktionary data already
+    Returns
+    -------
+    Optional[NoteFingerprints]
+        In the incremental mode, the updated fingerprints of the notes, else None. They are not saved, save
+        them only after the deck was written, so a failed write does not mark the notes as filled.
     """
-    # Currently, the deck consist of three fields (vi, en, examples). Extract the deck to a list:
-    print("Loading the deck and Wiktionary data...")
-    deck, metadata = load_deck(deck_csv_path)
-
     print("Loading Wiktionary data...")
-    wikt_df = load_wiktextract(wikt_extract)
+    if stream:
+        deck_words = [
+            note_dict["vi"]
+            for note_dict in deck
+            if refill or incremental or not note_dict["wiktdata"]
+        ]
+        wikt_index = load_wiktextract_subset(wikt_extract, deck_words, lang_code)
+    else:
+        wikt_index = load_wiktionary_index(wikt_extract, cache_dir, use_cache)
 
     filter_words = filters.split(";")
     print("Filters:", filter_words)
 
     not_found = []
 
+    fingerprints = None
+    if incremental:
+        fingerprints = NoteFingerprints(fingerprints_path)
+
+    # Skip the words that already have Wiktionary data if we are not refilling,
+    # in the incremental mode only if their inputs and fields did not change
+    notes_to_fill = []
+    note_entries = []  # Entries of the notes to fill for their new fingerprints
+    for note_dict in deck:
+        changed = False
+        if fingerprints is not None:
+            entries = get_entry_records(wikt_index, note_dict["vi"])
+            fingerprint = note_fingerprint(
+                note_dict["vi"],
+                entries,
+                filter_words,
+                note_dict["en"],
+                note_dict["wiktdata"],
+            )
+            changed = fingerprints.changed(note_key(note_dict), fingerprint)
+        if refill or changed or not note_dict["wiktdata"]:
+            notes_to_fill.append(note_dict)
+            if fingerprints is not None:
+                note_entries.append(entries)
+    if fingerprints is not None:
+        print(f"Incremental: {len(notes_to_fill)} of {len(deck)} notes need filling")
+
+    words = [note_dict["vi"] for note_dict in notes_to_fill]
+
     # Process the deck
     print("Looking for wikt entries...")
-    with tqdm(total=len(deck)) as pbar:
-        for note_dict in deck:
-            pbar.set_description(f"Processing {note_dict['vi']}")
-            pbar.update(1)
-
-            # Skip the word if it already has Wiktionary data and we are not refilling
-            if "wiktdata" in note_dict and note_dict["wiktdata"] and not refill:
-                continue
-
-            found_entries = get_entries(wikt_df, note_dict["vi"])
-            if not found_entries.empty:
-                json_str, short_str = json_dump_entries(
-                    found_entries, word=note_dict["vi"], filter_words=filter_words
-                )
-                note_dict["en"] = short_str
-                note_dict["wiktdata"] = json_str
-            else:
-                note_dict["wiktdata"] = "None"
-                not_found.append(note_dict["vi"])
+    with tqdm(total=len(notes_to_fill)) as pbar:
+        if workers > 1:
+            pool = _pool_context().Pool(
+                workers, initializer=_init_worker, initargs=(wikt_index, filter_words)
+            )
+            results = pool.imap(_lookup_note_worker, words, chunksize=32)
+        else:
+            pool = None
+            results = (lookup_note(wikt_index, word, filter_words) for word in words)
+
+        try:
+            # imap yields in order, so the deck and not_found keep their order
+            for note_dict, result in zip(notes_to_fill, results):
+                pbar.set_description(f"Processing {note_dict['vi']}")
+                pbar.update(1)
+
+                if result is not None:
+                    json_str, short_str = result
+                    note_dict["en"] = short_str
+                    note_dict["wiktdata"] = json_str
+                else:
+                    note_dict["wiktdata"] = "None"
+                    not_found.append(note_dict["vi"])
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    if fingerprints is not None:
+        for note_dict, entries in zip(notes_to_fill, note_entries):
+            fingerprints.update(
+                note_key(note_dict),
+                note_fingerprint(
+                    note_dict["vi"],
+                    entries,
+                    filter_words,
+                    note_dict["en"],
+                    note_dict["wiktdata"],
+                ),
+            )
+        fingerprints.dump_version = source_fingerprint(wikt_extract)
 
     if not_found:
         print(
@@ -269,7 +378,78 @@ def extract_and_fill(
         with open("not_found.txt", "w", encoding="utf-8") as f:
             for word in not_found:
                 f.write(word + "\n")
-    return deck, metadata
+
+    return fingerprints
+
+
+def extract_and_fill(
+    wikt_extract: str,
+    deck_csv_path: str,
+    filters: str = "Sino-Vietnamese Reading of",
+    refill: bool = False,
+    cache_dir: Optional[str] = None,
+    use_cache: bool = True,
+    stream: bool = False,
+    lang_code: Optional[str] = None,
+    workers: int = 1,
+    incremental: bool = False,
+    fingerprints_path: Optional[str] = None,
+    out_path: Optional[str] = None,
+) -> tuple[List[dict], List[str], Optional[NoteFingerprints]]:
+    """Extracts and fills the Anki deck with Wiktionary data.
+
+    Parameters
+    ----------
+    wikt_extract : str
+        Path to the wiktextract JSONL file
+    deck_csv_path : str
+        Path to the Anki deck CSV file, which uses tab as a separator by default. The deck should be exported with identifiers.
+    filters : str, optional
+        Filters to apply to the meanings
+    refill : bool, optional
+        Refill the deck even if it has Wiktionary data already
+    cache_dir : str, optional
+        Folder for the compiled Wiktionary store. Defaults to `.wikt_cache` next to the JSONL file
+    use_cache : bool, optional
+        Use (and create) the compiled Wiktionary store instead of parsing the JSONL file on every run
+    stream : bool, optional
+        Stream the JSONL file and only keep the entries of the words in the deck, instead of loading all of it
+    lang_code : str, optional
+        Only keep entries of this language when streaming, for multilingual dumps
+    workers : int, optional
+        Number of processes to look up the notes with. The order of the deck and of not_found.txt is kept.
+    incremental : bool, optional
+        Only refill the notes whose word, Wiktionary entries or filters changed since the last incremental run
+    fingerprints_path : str, optional
+        Sidecar file with the fingerprints of the notes for the incremental mode.
+        Defaults to `<deck>.wikt_fingerprints.json` next to the output deck
+    out_path : str, optional
+        Path the filled deck will be written to, defaults to `deck_csv_path`
+
+    Returns
+    -------
+    tuple[List[dict], List[str], Optional[NoteFingerprints]]
+        The filled deck, its metadata and the fingerprints to save after writing the deck, see `fill_deck`
+    """
+    # Currently, the deck consist of three fields (vi, en, examples). Extract the deck to a list:
+    print("Loading the deck...")
+    deck, metadata = load_deck(deck_csv_path)
+
+    fingerprints = fill_deck(
+        deck,
+        wikt_extract,
+        filters,
+        refill,
+        cache_dir=cache_dir,
+        use_cache=use_cache,
+        stream=stream,
+        lang_code=lang_code,
+        workers=workers,
+        incremental=incremental,
+        fingerprints_path=fingerprints_path
+        or fingerprints_path_for(out_path or deck_csv_path),
+    )
+    return deck, metadata, fingerprints
 
 
 if __name__ == "__main__":
@@ -302,6 +482,45 @@ if __name__ == "__main__":
         action="store_true",
         help="Refill the deck even if it has Wiktionary data already",
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Folder for the compiled Wiktionary store. Defaults to .wikt_cache next to the JSONL file",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Parse the JSONL file without reading or writing the compiled Wiktionary store",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the JSONL file and only keep the entries of the words in the deck (low memory)",
+    )
+    parser.add_argument(
+        "--lang_code",
+        type=str,
+        default=None,
+        help="Only keep entries of this language code when streaming, e.g. vi for multilingual dumps",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to look up the notes with",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only refill the notes whose Wiktionary entries or filters changed since the last incremental run",
+    )
+    parser.add_argument(
+        "--fingerprints",
+        type=str,
+        default=None,
+        help="Sidecar file with the note fingerprints for --incremental. Defaults to <out>.wikt_fingerprints.json",
+    )
 
     args = parser.parse_args()
     # Check all arguments filled
@@ -311,9 +530,23 @@ if __name__ == "__main__":
     # Backup the original deck first
     shutil.copy(args.deck, args.deck + ".wikt_bak")
 
-    deck, metadata = extract_and_fill(
-        args.wikt_extract, args.deck, args.filters, args.refill
+    deck, metadata, fingerprints = extract_and_fill(
+        args.wikt_extract,
+        args.deck,
+        args.filters,
+        args.refill,
+        cache_dir=args.cache_dir,
+        use_cache=not args.no_cache,
+        stream=args.stream,
+        lang_code=args.lang_code,
+        workers=args.workers,
+        incremental=args.incremental,
+        fingerprints_path=args.fingerprints,
+        out_path=args.out,
     )
 
     print("Writing the deck...")
     write_deck(deck, metadata, args.out)
+    # Only after the deck was written, so the notes are not marked as filled if writing failed
+    if fingerprints is not None:
+        fingerprints.save()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+from typing import List, Optional
+
+# Bump this whenever the conversion of the entries changes, so that all notes are recomputed
+FINGERPRINT_VERSION = 2
+
+
+def fingerprints_path_for(deck_path: str) -> str:
+    """Returns the default sidecar file of a written deck, e.g. deck.wikt_fingerprints.json for deck.csv."""
+    return os.path.splitext(os.path.abspath(deck_path))[0] + ".wikt_fingerprints.json"
+
+
+def note_key(note_dict: dict) -> str:
+    """Returns the key of a note in the fingerprint file, the Anki note id if the deck was exported with ids."""
+    return note_dict["id"] or note_dict["vi"]
+
+
+def note_fingerprint(
+    word: str, entries: List[dict], filter_words: List[str], en: str, wiktdata: str
+) -> str:
+    """Computes the fingerprint of all inputs of a note's Wiktionary data and of the filled fields.
+
+    As the filled fields are part of it, a note only matches its stored fingerprint if the deck that was
+    loaded holds the data that was filled, not e.g. an older copy of the deck.
+
+    Parameters
+    ----------
+    word : str
+        The word of the note
+    entries : List[dict]
+        The Wiktionary entries of the word, see `get_entry_records`
+    filter_words : List[str]
+        Words to filter out from the meanings
+    en : str
+        The field en of the note
+    wiktdata : str
+        The field wiktdata of the note
+
+    Returns
+    -------
+    str
+        A hex digest that changes if the word, its entries, the filters or the filled fields change
+    """
+    data = json.dumps(
+        [FINGERPRINT_VERSION, word, filter_words, entries, en, wiktdata],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class NoteFingerprints:
+    """Sidecar file with the fingerprint of each filled note, keyed by `note_key`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file. It is created on `save` if it does not exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.dump_version: Optional[str] = None
+        self.fingerprints: dict[str, str] = {}
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.dump_version = data.get("dump_version")
+            self.fingerprints = data.get("notes", {})
+
+    def changed(self, key: str, fingerprint: str) -> bool:
+        """Returns True if the fingerprint of a note changed since the last saved run."""
+        return self.fingerprints.get(key) != fingerprint
+
+    def update(self, key: str, fingerprint: str):
+        """Stores the fingerprint of a filled note. Only save after the deck was written."""
+        self.fingerprints[key] = fingerprint
+
+    def save(self, dump_version: Optional[str] = None):
+        """Writes the fingerprints, replacing the previous file atomically."""
+        if dump_version is not None:
+            self.dump_version = dump_version
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"dump_version": self.dump_version, "notes": self.fingerprints}, f
+            )
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,255 @@
+import re
+from collections import defaultdict
+from typing import Iterable, List, Optional, Sequence
+
+import pandas as pd
+
+
+def normalize_headword(word: str) -> str:
+    """Normalizes a headword so that lookups are case insensitive."""
+    return str(word).casefold()
+
+
+ALTERNATIVE_SPELLING = "Alternative spelling of"
+ALTERNATIVE_SPELLING_REGEX = re.compile(rf"{ALTERNATIVE_SPELLING} (.+)")
+
+
+def _glosses(record: dict) -> List[str]:
+    return [
+        gloss
+        for sense in record.get("senses", [])
+        for gloss in sense.get("glosses", [])
+    ]
+
+
+def is_alternative_spelling(record: dict) -> bool:
+    """Checks if all glosses of a single entry are "Alternative spelling of" redirects."""
+    return all(ALTERNATIVE_SPELLING in gloss for gloss in _glosses(record))
+
+
+def alternative_spelling_target(records: List[dict]) -> Optional[str]:
+    """Finds the target of an "Alternative spelling of X" redirect.
+
+    Parameters
+    ----------
+    records : List[dict]
+        All Wiktionary entries of one headword.
+
+    Returns
+    -------
+    Optional[str]
+        The alternative spelling X if all senses of the entries are alternative spellings, otherwise None.
+    """
+    glosses = [gloss for record in records for gloss in _glosses(record)]
+    if not glosses or not all(ALTERNATIVE_SPELLING in gloss for gloss in glosses):
+        return None
+
+    first_gloss = glosses[0]
+    match = ALTERNATIVE_SPELLING_REGEX.search(first_gloss)
+    if not match:
+        print(f"WARN: Tried but not find alternative spelling in {first_gloss}")
+        return None
+
+    alternative_spelling: str = match.group(1)
+    # Case: Explanation in Brackets
+    # Ex: Alternative spelling of tổng thư kí (“Secretary General”)
+    bracket_i = alternative_spelling.find(" (")
+    if bracket_i != -1:
+        alternative_spelling = alternative_spelling[:bracket_i]
+    # Case: Only provided alternative spelling
+    if alternative_spelling.endswith("."):
+        alternative_spelling = alternative_spelling[:-1]
+    return alternative_spelling
+
+
+def resolve_redirects(targets: dict[str, str]) -> dict[str, str]:
+    """Resolves chains of alternative spellings to their final headword.
+
+    Parameters
+    ----------
+    targets : dict[str, str]
+        Mapping from normalized headword to the normalized headword it is an alternative spelling of.
+
+    Returns
+    -------
+    dict[str, str]
+        Mapping from normalized headword to the first headword of its chain that is not a redirect itself.
+        Headwords whose chain ends in a cycle are left out, so they keep their own entries.
+    """
+    resolved: dict[str, str] = {}
+    for headword in targets:
+        chain = [headword]
+        current = targets[headword]
+        while current in targets and current not in chain:
+            chain.append(current)
+            current = targets[current]
+
+        if current in chain:  # Cycle, e.g. a -> b -> a
+            continue
+        resolved[headword] = current
+    return resolved
+
+
+class WiktionaryIndex:
+    """Hash index over Wiktionary entries, keyed by the casefolded headword.
+
+    The index is built once and maps each headword to the positions of its entries,
+    so a lookup does not need to scan the whole Wiktionary dump.
+
+    Parameters
+    ----------
+    records : Sequence[dict]
+        The Wiktionary entries, one dict per wiktextract line.
+    positions : dict[str, List[int]], optional
+        A precomputed mapping from normalized headword to record positions, e.g. from a compiled store.
+        Built from the records if not given.
+    redirects : dict[str, str], optional
+        A precomputed mapping from normalized headword to the headword it is an alternative spelling of,
+        with chains already resolved, see `resolve_redirects`. Built from the records if not given.
+    """
+
+    def __init__(
+        self,
+        records: Sequence[dict],
+        positions: Optional[dict[str, List[int]]] = None,
+        redirects: Optional[dict[str, str]] = None,
+    ):
+        self.records = records
+
+        if positions is None:
+            positions = defaultdict(list)
+            for i, record in enumerate(records):
+                positions[normalize_headword(record.get("word", ""))].append(i)
+        self._positions = dict(positions)
+
+        if redirects is None:
+            redirects = self._build_redirects()
+        self._redirects = redirects
+
+    def _build_redirects(self) -> dict[str, str]:
+        targets = {}
+        for headword, positions in self._positions.items():
+            entries = [self.records[i] for i in positions]
+            if not all(is_alternative_spelling(entry) for entry in entries):
+                continue
+            target = alternative_spelling_target(entries)
+            if target is not None:
+                targets[headword] = normalize_headword(target)
+        return resolve_redirects(targets)
+
+    @classmethod
+    def from_dataframe(cls, wikt_df: pd.DataFrame) -> "WiktionaryIndex":
+        """Builds the index from the output of `load_wiktextract`."""
+        return cls(wikt_df.to_dict(orient="records"))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, word: str) -> bool:
+        return normalize_headword(word) in self._positions
+
+    def headwords(self) -> Iterable[str]:
+        """Returns all normalized headwords of the index."""
+        return self._positions.keys()
+
+    def positions(self, word: str) -> List[int]:
+        """Returns the positions of all entries with the given headword (case insensitive)."""
+        return self._positions.get(normalize_headword(word), [])
+
+    @property
+    def redirects(self) -> dict[str, str]:
+        """Mapping from normalized headword to the headword it is an alternative spelling of."""
+        return self._redirects
+
+    def resolve(self, word: str) -> str:
+        """Returns the normalized headword, following "Alternative spelling of" redirects."""
+        headword = normalize_headword(word)
+        return self._redirects.get(headword, headword)
+
+    def entries(self, word: str) -> List[dict]:
+        """Retrieves all entries with the given headword (case insensitive) as plain dicts.
+
+        This is the fast path used for serializing, it does not build a DataFrame.
+        """
+        return [self.records[i] for i in self.positions(word)]
+
+    def lookup(self, word: str) -> pd.DataFrame:
+        """Retrieves all entries with the given headword (case insensitive).
+
+        Parameters
+        ----------
+        word : str
+            The word to search for.
+
+        Returns
+        -------
+        pd.DataFrame
+            A DataFrame containing the matching entries. Empty if the word was not found.
+        """
+        entries = self.entries(word)
+        if not entries:
+            return pd.DataFrame()
+        return pd.DataFrame(entries).fillna("")
+
+
+class HeadwordTrie:
+    """Trie over the space separated tokens of headwords, to find all headwords in a sentence in one pass.
+
+    Parameters
+    ----------
+    headwords : Iterable[str]
+        The normalized headwords, see `normalize_headword`.
+    """
+
+    END = None  # Key of a node where a headword ends, can't collide with a token
+
+    def __init__(self, headwords: Iterable[str]):
+        self.root: dict = {}
+        self.max_depth = 0
+        for headword in headwords:
+            tokens = headword.split(" ")
+            if not all(tokens):  # Can never match a space joined sequence of words
+                continue
+            node = self.root
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[self.END] = True
+            self.max_depth = max(self.max_depth, len(tokens))
+
+    @classmethod
+    def from_index(cls, wikt_index: WiktionaryIndex) -> "HeadwordTrie":
+        """Builds the trie of all headwords that have entries in the index, including through redirects."""
+        return cls(
+            headword
+            for headword in wikt_index.headwords()
+            if wikt_index.positions(wikt_index.resolve(headword))
+        )
+
+    def find_all(
+        self, tokens: List[str], max_len: Optional[int] = None
+    ) -> List[tuple[int, int]]:
+        """Finds all headwords occurring in a sequence of normalized tokens.
+
+        Parameters
+        ----------
+        tokens : List[str]
+            The normalized words of a sentence.
+        max_len : int, optional
+            Only find headwords with at most this many tokens.
+
+        Returns
+        -------
+        List[tuple[int, int]]
+            The start position and number of tokens of each occurrence, ordered by start position.
+        """
+        max_len = min(max_len or self.max_depth, self.max_depth)
+        found = []
+        for start in range(len(tokens)):
+            node = self.root
+            for n, token in enumerate(tokens[start : start + max_len], 1):
+                node = node.get(token)
+                if node is None:
+                    break
+                if self.END in node:
+                    found.append((start, n))
+        return found
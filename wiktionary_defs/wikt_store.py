@@ -0,0 +1,330 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+from collections import defaultdict
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+from wiktionary_defs.wikt_index import (
+    WiktionaryIndex,
+    alternative_spelling_target,
+    is_alternative_spelling,
+    normalize_headword,
+    resolve_redirects,
+)
+
+# Bump this whenever the layout or the preprocessing of the compiled store changes
+STORE_VERSION = 2
+RECORDS_FILE = "records.bin"
+OFFSETS_FILE = "offsets.npy"
+INDEX_FILE = "index.json"
+META_FILE = "meta.json"
+
+# Matches the value of every "word" key of a raw JSONL line, including nested ones (synonyms, forms, ...)
+WORD_FIELD_REGEX = re.compile(r'"word"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def clean_record(record: dict) -> dict:
+    """Removes control characters from the top level string fields of a wiktextract record.
+
+    This mirrors the replacement done by `load_wiktextract` on the DataFrame.
+    """
+    for key, value in record.items():
+        if isinstance(value, str):
+            record[key] = value.replace("\n", " ").replace("\t", " ")
+    return record
+
+
+def iter_wiktextract(file_path: str) -> Iterator[dict]:
+    """Reads a wiktextract JSONL file line by line and yields the cleaned records.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the JSONL file to be loaded.
+
+    Yields
+    ------
+    dict
+        One wiktextract record per non-empty line.
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield clean_record(json.loads(line))
+
+
+def _line_may_contain(line: str, headwords: set[str]) -> bool:
+    """Fast path to check if a raw JSONL line may have one of the headwords, without decoding the line.
+
+    Every "word" value of the line is checked, so nested keys can only cause false positives.
+    """
+    for value in WORD_FIELD_REGEX.findall(line):
+        if "\\" in value:
+            value = json.loads(f'"{value}"')
+        if normalize_headword(value) in headwords:
+            return True
+    return False
+
+
+def _scan_wiktextract(
+    file_path: str, headwords: set[str], lang_code: Optional[str] = None
+) -> List[dict]:
+    """Reads the records of a wiktextract JSONL file whose headword is in `headwords`."""
+    records = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not _line_may_contain(line, headwords):
+                continue
+            record = json.loads(line)
+            if normalize_headword(record.get("word", "")) not in headwords:
+                continue
+            if lang_code is not None and record.get("lang_code") != lang_code:
+                continue
+            records.append(clean_record(record))
+    return records
+
+
+def load_wiktextract_subset(
+    file_path: str,
+    words: Iterable[str],
+    lang_code: Optional[str] = None,
+    max_redirects: int = 5,
+) -> WiktionaryIndex:
+    """Streams a wiktextract JSONL file and only keeps the entries of the given words.
+
+    The file is read line by line and only lines that contain one of the words are decoded, so the memory
+    usage depends on the number of words and not on the size of the dump. Targets of "Alternative spelling
+    of" entries are collected in additional passes over the file.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the wiktextract JSONL file.
+    words : Iterable[str]
+        The headwords to keep, e.g. the `vi` field of the deck.
+    lang_code : str, optional
+        Only keep entries of this language, for multilingual dumps.
+    max_redirects : int, optional
+        The maximum number of passes to resolve chains of alternative spellings.
+
+    Returns
+    -------
+    WiktionaryIndex
+        The index over the kept entries.
+    """
+    records: List[dict] = []
+    searched: set[str] = set()
+    pending = {normalize_headword(word) for word in words}
+
+    for _ in range(max_redirects + 1):
+        if not pending:
+            break
+        found = _scan_wiktextract(file_path, pending, lang_code)
+        records.extend(found)
+        searched |= pending
+
+        by_headword = defaultdict(list)
+        for record in found:
+            by_headword[normalize_headword(record.get("word", ""))].append(record)
+        targets = (alternative_spelling_target(recs) for recs in by_headword.values())
+        pending = {
+            normalize_headword(target) for target in targets if target is not None
+        } - searched
+
+    return WiktionaryIndex(records)
+
+
+def source_fingerprint(file_path: str, sample_size: int = 1 << 20) -> str:
+    """Computes a cheap fingerprint of the source file.
+
+    The fingerprint combines the size and modification time of the file with a hash of its first and last
+    `sample_size` bytes, so that it is computed in constant time even for multi-GB dumps.
+    """
+    stat = os.stat(file_path)
+    digest = hashlib.sha256(f"{STORE_VERSION}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(file_path, "rb") as f:
+        digest.update(f.read(sample_size))
+        if stat.st_size > sample_size:
+            f.seek(max(sample_size, stat.st_size - sample_size))
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def default_cache_dir(file_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), ".wikt_cache")
+
+
+def store_path(file_path: str, cache_dir: Optional[str] = None) -> str:
+    """Returns the folder of the compiled store for the current version of the source file."""
+    cache_dir = cache_dir or default_cache_dir(file_path)
+    name = os.path.basename(file_path)
+    return os.path.join(cache_dir, f"{name}.{source_fingerprint(file_path)[:16]}")
+
+
+class MappedRecords(Sequence):
+    """Read-only sequence of wiktextract records backed by a memory-mapped file.
+
+    Records are stored as compact JSON in one contiguous blob and are only decoded when accessed.
+    Pickling only transfers the folder, so worker processes map the same pages instead of copying them.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+        self._file = open(os.path.join(folder, RECORDS_FILE), "rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:  # mmap cannot map empty files
+            self._blob = b""
+
+    def __getstate__(self):
+        return {"folder": self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Record index {i} out of range")
+        return json.loads(self._blob[self.offsets[i] : self.offsets[i + 1]])
+
+
+def compile_wiktextract(file_path: str, cache_dir: Optional[str] = None) -> str:
+    """Compiles a wiktextract JSONL file into a memory-mappable store.
+
+    The store consists of the cleaned records as one contiguous UTF-8 blob, their offsets, the
+    headword index and the resolved alternative spelling redirects. It is written to a temporary folder first and then moved in place.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the wiktextract JSONL file.
+    cache_dir : str, optional
+        The folder for the compiled stores. Defaults to `.wikt_cache` next to the source file.
+
+    Returns
+    -------
+    str
+        The folder of the compiled store.
+    """
+    out_folder = store_path(file_path, cache_dir)
+    tmp_folder = out_folder + f".tmp{os.getpid()}"
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    offsets = [0]
+    positions: dict[str, List[int]] = defaultdict(list)
+    # Only keep the entries that are redirects, a headword is a redirect if all its entries are
+    alternative_entries: dict[str, List[dict]] = defaultdict(list)
+    with open(os.path.join(tmp_folder, RECORDS_FILE), "wb") as blob:
+        for i, record in enumerate(iter_wiktextract(file_path)):
+            data = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+            offsets.append(offsets[-1] + blob.write(data.encode("utf-8")))
+
+            headword = normalize_headword(record.get("word", ""))
+            positions[headword].append(i)
+            if is_alternative_spelling(record):
+                alternative_entries[headword].append(record)
+
+    targets = {}
+    for headword, entries in alternative_entries.items():
+        if len(entries) != len(positions[headword]):
+            continue
+        target = alternative_spelling_target(entries)
+        if target is not None:
+            targets[headword] = normalize_headword(target)
+
+    np.save(os.path.join(tmp_folder, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(tmp_folder, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(
+            {"positions": positions, "redirects": resolve_redirects(targets)},
+            f,
+            ensure_ascii=False,
+        )
+    with open(os.path.join(tmp_folder, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "source": os.path.abspath(file_path),
+                "fingerprint": source_fingerprint(file_path),
+                "records": len(offsets) - 1,
+            },
+            f,
+        )
+
+    if os.path.exists(out_folder):
+        shutil.rmtree(out_folder)
+    os.replace(tmp_folder, out_folder)
+    return out_folder
+
+
+def load_compiled(folder: str) -> WiktionaryIndex:
+    """Loads a compiled store as a `WiktionaryIndex` with memory-mapped records."""
+    with open(os.path.join(folder, INDEX_FILE), "r", encoding="utf-8") as f:
+        index = json.load(f)
+    return WiktionaryIndex(
+        MappedRecords(folder),
+        positions=index["positions"],
+        redirects=index["redirects"],
+    )
+
+
+def load_wiktionary_index(
+    file_path: str, cache_dir: Optional[str] = None, use_cache: bool = True
+) -> WiktionaryIndex:
+    """Loads the Wiktionary index, compiling the source file once if needed.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the wiktextract JSONL file.
+    cache_dir : str, optional
+        The folder for the compiled stores. Defaults to `.wikt_cache` next to the source file.
+    use_cache : bool, optional
+        If False, parse the JSONL file into memory without reading or writing a compiled store.
+
+    Returns
+    -------
+    WiktionaryIndex
+        The index over the Wiktionary entries.
+    """
+    if not use_cache:
+        return WiktionaryIndex(list(iter_wiktextract(file_path)))
+
+    folder = store_path(file_path, cache_dir)
+    if not os.path.exists(os.path.join(folder, META_FILE)):
+        print(f"Compiling Wiktionary data to {folder} (only needed once)...")
+        compile_wiktextract(file_path, cache_dir)
+    return load_compiled(folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compiles a wiktextract JSONL file into a memory-mappable store."
+    )
+    parser.add_argument(
+        "--wikt_extract",
+        type=str,
+        help="Path to the wiktextract JSONL file",
+        required=True,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Folder for the compiled stores. Defaults to .wikt_cache next to the JSONL file",
+    )
+    args = parser.parse_args()
+
+    print("Compiled to", compile_wiktextract(args.wikt_extract, args.cache_dir))